@@ -4,7 +4,15 @@
 # http://www.indigodomo.com
 
 import indigo
+import bisect
+import heapq
+import itertools
+import json
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Note the "indigo" module is automatically imported and made available inside
 # our global name space by the host process.
@@ -18,6 +26,37 @@ kSpeedIndex = {
     2:  'medium',
     3:  'high',
     }
+kSpeedIndexCount = len(kSpeedIndex)
+kSpeedIndexNames = dict((name, index) for index, name in kSpeedIndex.items())
+
+kNestableTypes  = ('fanGroupFull', 'fanGroupSimple')    # group types that other groups may contain
+
+kTrendSamples   = 5     # temperature samples used to estimate the thermostat trend
+
+kCommandTimeout = 10.0  # seconds to wait for a fan to report a commanded value
+kCommandRetries = 2     # resends (with doubling timeout) before a command is given up
+
+# outgoing command priority when rate limited, lower goes first
+kPriorityUser       = 0     # device actions
+kPriorityAutomation = 1     # thermostat assist
+
+kCommandNames = {
+    'speedIndex':   'speedcontrol.setSpeedIndex',
+    'speedLevel':   'speedcontrol.setSpeedLevel',
+    }
+
+kSnapshotVersion    = 1
+kSnapshotInterval   = 300   # seconds between periodic snapshot saves
+kSnapshotMaxAge     = 3600  # older thermostat samples and schedules are not restored
+
+kTraceVersion       = 1
+kTraceFiles         = 3     # current trace file plus rotated ones
+
+kEventQueueLimit    = 5000  # queued updates before fans and thermostats are re-read instead
+
+# upper bounds (seconds) of the latency histogram buckets; one more bucket catches the rest
+kLatencyBuckets = (50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 1.0)
+kPerfTopGroups  = 10
 
 ################################################################################
 class Plugin(indigo.PluginBase):
@@ -36,13 +75,45 @@ class Plugin(indigo.PluginBase):
         self.logger.debug("startup")
         if self.debug:
             self.logger.debug("Debug logging enabled")
-        self.deviceDict = dict()
+        self.settleTime  = float(self.pluginPrefs.get('settleTime',5))
+        self.perf        = self.PerfStats() if self.pluginPrefs.get('perfStats',False) else None
+        self.trace       = None
+        self.scheduler   = self.Scheduler(self)
+        self.events      = self.EventQueue(self)
+        self.events.configure(self.pluginPrefs)
+        self.dispatcher  = self.CommandDispatcher(self)
+        self.dispatcher.configure(self.pluginPrefs)
+        self.pending     = self.PendingCommands(self)
+        self.snapshot    = self.Snapshot(self)
+        self.snapshot.load()
+        self.deviceDict  = dict()
+        self.fans        = dict()
+        self.thermostats = dict()
+        self.catalog     = self.DeviceCatalog(self)
+        # one pass over all fans so groups starting up don't each query the server;
+        # only used until runConcurrentThread starts (i.e. after deviceStartComm calls)
+        self.fanSnapshot = dict()
+        for dev in indigo.devices.iter('indigo.speedcontrol'):
+            self.catalog.add(dev)
+            self.fanSnapshot[dev.id] = self.ControlledFan.project(dev)
+        for dev in indigo.devices.iter('indigo.thermostat'):
+            self.catalog.add(dev)
+        for dev in indigo.devices.iter('self'):
+            self.catalog.add(dev)
         indigo.devices.subscribeToChanges()
+        self.snapshotJob = self.scheduler.schedule(time.time()+kSnapshotInterval, self.saveSnapshot)
+        self.configureTrace(self.pluginPrefs)
 
     #-------------------------------------------------------------------------------
     def shutdown(self):
         self.logger.debug("shutdown")
         self.pluginPrefs['showDebugInfo'] = self.debug
+        self.snapshotJob = self.scheduler.cancel(self.snapshotJob)
+        self.snapshot.save()
+        if self.trace:
+            self.trace.close()
+        self.pending.stop()
+        self.dispatcher.stop()
 
     #-------------------------------------------------------------------------------
     def closedPrefsConfigUi(self, valuesDict, userCancelled):
@@ -51,28 +122,66 @@ class Plugin(indigo.PluginBase):
             self.debug = valuesDict.get("showDebugInfo",False)
             if self.debug:
                 self.logger.debug("Debug logging enabled")
+            self.settleTime = float(valuesDict.get('settleTime',5))
+            self.events.configure(valuesDict)
+            self.dispatcher.configure(valuesDict)
+            if not valuesDict.get('perfStats',False):
+                self.perf = None
+            elif not self.perf:
+                self.perf = self.PerfStats()
+            self.configureTrace(valuesDict)
+
+    #-------------------------------------------------------------------------------
+    def configureTrace(self, prefs):
+        maxBytes = int(prefs.get('traceMaxSize',5)) * 1024*1024
+        if self.trace and (not prefs.get('traceEvents',False) or maxBytes != self.trace.maxBytes):
+            self.trace.close()
+            self.trace = None
+        if prefs.get('traceEvents',False) and not self.trace:
+            self.trace = self.TraceRecorder(self, maxBytes)
 
     #-------------------------------------------------------------------------------
     def runConcurrentThread(self):
         self.logger.debug("runConcurrentThread")
+        self.fanSnapshot = dict()
+        # from here on callbacks queue their work for this thread
+        self.events.start()
         try:
             while True:
-                loopTime = time.time()
-                for devId, device in self.deviceDict.items():
-                    device.loopAction()
-                self.sleep(loopTime+10-time.time())
+                self.events.drain()
+                self.scheduler.runDue()
+                # sleep until the earliest job, a sooner job is added or an event is queued
+                self.scheduler.wait(self.events.waiting)
+                if self.stopThread:
+                    raise self.StopThread
         except self.StopThread:
             pass    # Optionally catch the StopThread exception and do any needed cleanup.
+        finally:
+            self.events.stop()
+
+    #-------------------------------------------------------------------------------
+    def saveSnapshot(self):
+        self.snapshot.save()
+        self.snapshotJob = self.scheduler.schedule(time.time()+kSnapshotInterval, self.saveSnapshot)
+
+    #-------------------------------------------------------------------------------
+    def stopConcurrentThread(self):
+        indigo.PluginBase.stopConcurrentThread(self)
+        self.scheduler.wake()
 
     #-------------------------------------------------------------------------------
     # Device Methods
     #-------------------------------------------------------------------------------
     def deviceStartComm(self, device):
         self.logger.debug("deviceStartComm: "+device.name)
+        self.events.call(self.startGroup, device)
 
+    #-------------------------------------------------------------------------------
+    def startGroup(self, device):
         if device.version != self.pluginVersion:
             self.updateDeviceVersion(device)
 
+        self.catalog.add(device)
         if device.configured:
             if device.deviceTypeId == 'fanGroupSimple':
                 self.deviceDict[device.id] = self.GroupRelay(device, self)
@@ -80,23 +189,94 @@ class Plugin(indigo.PluginBase):
                 self.deviceDict[device.id] = self.GroupSpeedcontrol(device, self)
             elif device.deviceTypeId == 'thermAssist':
                 self.deviceDict[device.id] = self.GroupThermAssist(device, self)
-            self.deviceDict[device.id].updateGroup()
+            if device.id in self.deviceDict:
+                trace = self.trace
+                if trace:
+                    trace.recordGroup(self.deviceDict[device.id])
+                self.deviceDict[device.id].updateGroup()
+                self.refreshDependents(device.id)
 
     #-------------------------------------------------------------------------------
     def deviceStopComm(self, device):
         self.logger.debug("deviceStopComm: "+device.name)
+        self.events.call(self.stopGroup, device)
+
+    #-------------------------------------------------------------------------------
+    def stopGroup(self, device):
         if device.id in self.deviceDict:
+            trace = self.trace
+            if trace:
+                trace.record('stop', id=device.id)
+            self.snapshot.keepGroup(self.deviceDict[device.id])
+            self.deviceDict[device.id].stop()
             del self.deviceDict[device.id]
 
+    #-------------------------------------------------------------------------------
+    def acquireFan(self, fanId, devGroup):
+        # one shared ControlledFan per device, referenced by the groups that contain it
+        fan = self.fans.get(fanId)
+        if not fan:
+            fan = self.fans[fanId] = self.ControlledFan(fanId, self.fanSnapshot.get(fanId))
+        fan.groups[devGroup.id] = devGroup
+        fan.ordered = None
+        return fan
+
+    #-------------------------------------------------------------------------------
+    def refreshDependents(self, groupId):
+        # groups containing groupId (at any depth) re-expand their leaf fans
+        for devGroup in list(self.deviceDict.values()):
+            if groupId in devGroup.nested and devGroup.loadFans():
+                devGroup.updateGroup()
+
+    #-------------------------------------------------------------------------------
+    def releaseFan(self, fanId, devGroup):
+        fan = self.fans.get(fanId)
+        if fan:
+            fan.groups.pop(devGroup.id, None)
+            fan.ordered = None
+            if not fan.groups:
+                self.pending.release(fanId)
+                del self.fans[fanId]
+
+    #-------------------------------------------------------------------------------
+    def acquireThermostat(self, thermId, devGroup):
+        # one shared MonitoredThermostat per device, referenced by its subscribed groups
+        therm = self.thermostats.get(thermId)
+        if not therm:
+            therm = self.thermostats[thermId] = self.MonitoredThermostat(thermId, self)
+        therm.groups[devGroup.id] = devGroup
+        return therm
+
+    #-------------------------------------------------------------------------------
+    def releaseThermostat(self, thermId, devGroup):
+        therm = self.thermostats.get(thermId)
+        if therm:
+            therm.groups.pop(devGroup.id, None)
+            if therm.groups:
+                therm.schedulePoll()
+            else:
+                therm.stop()
+                self.snapshot.keepThermostat(therm)
+                del self.thermostats[thermId]
+
     #-------------------------------------------------------------------------------
     def validateDeviceConfigUi(self, valuesDict, typeId, devId, runtime=False):
         self.logger.debug("validateDeviceConfigUi: " + typeId)
         errorsDict = indigo.Dict()
 
-        if not valuesDict.get('fans',''):
+        fanIds = [int(fanId) for fanId in valuesDict.get('fans',[])]
+        if not fanIds:
             errorsDict['fans'] = "Select at least one fan"
+        elif devId in fanIds:
+            errorsDict['fans'] = "A group can't include itself"
+        elif not all(fanId in self.catalog.fans or fanId in self.catalog.groups for fanId in fanIds):
+            errorsDict['fans'] = "One or more selected fans no longer exist"
+        elif devId in self.catalog.expand(fanIds)[1]:
+            errorsDict['fans'] = "A selected group already contains this group"
 
         if typeId == 'thermAssist':
+            if int(valuesDict.get('thermostat',0) or 0) not in self.catalog.thermostats:
+                errorsDict['thermostat'] = "Select a thermostat"
             for key in ['onThreshold','offThreshold']:
                 if valuesDict.get(key,"") == "":
                     errorsDict[key] = "Required"
@@ -108,8 +288,29 @@ class Plugin(indigo.PluginBase):
                     except:
                         errorsDict[key] = "Must be positive real number"
             if not errorsDict:
-                if float(valuesDict['offThreshold']) > float(valuesDict['offThreshold']):
+                if float(valuesDict['offThreshold']) > float(valuesDict['onThreshold']):
                     errorsDict['offThreshold'] = "Must be less than or equal to ON Threshold"
+            # Temp Freq "Disable" turns adaptive polling off as well
+            if valuesDict.get('adaptivePoll',False) and int(valuesDict.get('tempFreq',300)):
+                if int(valuesDict.get('tempFreqMin',60)) > int(valuesDict.get('tempFreqMax',1800)):
+                    errorsDict['tempFreqMin'] = "Must be less than or equal to Max Temp Freq"
+
+        if len(errorsDict) > 0:
+            return (False, valuesDict, errorsDict)
+        else:
+            return (True, valuesDict)
+
+    #-------------------------------------------------------------------------------
+    def validateActionConfigUi(self, valuesDict, typeId, devId):
+        self.logger.debug("validateActionConfigUi: " + typeId)
+        errorsDict = indigo.Dict()
+
+        if typeId == 'setGroupSpeeds':
+            targets, errors = self.parseTargets(valuesDict.get('targets',''))
+            if errors:
+                errorsDict['targets'] = '; '.join(errors)
+            elif not targets:
+                errorsDict['targets'] = "Enter at least one group"
 
         if len(errorsDict) > 0:
             return (False, valuesDict, errorsDict)
@@ -130,31 +331,145 @@ class Plugin(indigo.PluginBase):
 
     #-------------------------------------------------------------------------------
     # Device updated
+    #-------------------------------------------------------------------------------
+    def deviceCreated(self, dev):
+        self.catalog.add(dev)
+        indigo.PluginBase.deviceCreated(self, dev)
+
+    #-------------------------------------------------------------------------------
+    def deviceDeleted(self, dev):
+        self.catalog.remove(dev.id)
+        if dev.pluginId == self.pluginId:
+            self.events.call(self.groupDeleted, dev.id)
+        indigo.PluginBase.deviceDeleted(self, dev)
+
+    #-------------------------------------------------------------------------------
+    def groupDeleted(self, devId):
+        self.snapshot.groups.pop(devId, None)
+        self.refreshDependents(devId)
+
     #-------------------------------------------------------------------------------
     def deviceUpdated(self, oldDev, newDev):
+        # most updates are for devices no group looks at, drop those before queueing
+        if (newDev.id in self.fans or newDev.id in self.thermostats or newDev.id in self.fanSnapshot
+                or newDev.pluginId == self.pluginId or oldDev.pluginId == self.pluginId
+                or newDev.name != oldDev.name):
+            self.events.post(newDev.id, oldDev, newDev)
+
+    #-------------------------------------------------------------------------------
+    def processDeviceUpdated(self, oldDev, newDev):
+        perf = self.perf
+        if perf:
+            perf.timed('deviceUpdated', None, self.handleDeviceUpdated, oldDev, newDev)
+        else:
+            self.handleDeviceUpdated(oldDev, newDev)
+
+    #-------------------------------------------------------------------------------
+    def handleDeviceUpdated(self, oldDev, newDev):
+        # prefs may turn stats or tracing off from another thread, read once
+        perf  = self.perf
+        trace = self.trace
+
+        if newDev.name != oldDev.name:
+            self.catalog.rename(newDev)
 
         # device belongs to plugin
         if newDev.pluginId == self.pluginId or oldDev.pluginId == self.pluginId:
             # update local copy (will be removed/overwritten if communication is stopped/re-started)
+            if newDev.pluginProps.get('fans') != oldDev.pluginProps.get('fans'):
+                self.catalog.add(newDev)
             if newDev.id in self.deviceDict:
                 self.deviceDict[newDev.id].refresh(newDev)
             indigo.PluginBase.deviceUpdated(self, oldDev, newDev)
 
-        # speedcontrol device
-        elif isinstance(newDev, indigo.SpeedControlDevice) and (newDev.speedLevel != oldDev.speedLevel):
-            for devId, device in self.deviceDict.items():
-                device.fanUpdated(oldDev, newDev)
-
-        # thermostat device
-        elif isinstance(newDev, indigo.ThermostatDevice) and (newDev.states != oldDev.states):
-            for devId, device in self.deviceDict.items():
-                device.thermUpdated(oldDev, newDev)
+        # speedcontrol device watched by at least one group
+        elif newDev.id in self.fans:
+            fan = self.fans[newDev.id]
+            # only the projected fields matter, drop anything else
+            if self.ControlledFan.project(newDev) != (fan.speedIndex, fan.speedLevel):
+                if trace:
+                    trace.record('fan', id=newDev.id, p=self.ControlledFan.project(newDev))
+                if perf:
+                    perf.count('fan updates delivered')
+                # refresh the shared fan once, then hand each group the old values
+                oldIndex, oldLevel = fan.speedIndex, fan.speedLevel
+                changed = fan.refresh(newDev)
+                self.pending.fanUpdated(fan)
+                # nested groups before the groups that contain them
+                for devGroup in fan.orderedGroups():
+                    devGroup.fanUpdated(fan, oldIndex, oldLevel, changed)
+            elif perf:
+                perf.count('fan updates dropped')
+
+        # thermostat device watched by at least one group
+        elif newDev.id in self.thermostats:
+            therm = self.thermostats[newDev.id]
+            if therm.project(newDev) != therm.projection:
+                if trace:
+                    trace.record('therm', id=newDev.id, p=therm.project(newDev))
+                if perf:
+                    perf.count('thermostat updates delivered')
+                therm.thermUpdated(newDev)
+            elif perf:
+                perf.count('thermostat updates dropped')
+
+        # keep the startup snapshot current until groups have started
+        elif newDev.id in self.fanSnapshot:
+            self.fanSnapshot[newDev.id] = self.ControlledFan.project(newDev)
 
 
     #-------------------------------------------------------------------------------
     # Action Methods
     #-------------------------------------------------------------------------------
     def actionControlSpeedControl(self, action, device):
+        # runs after any device updates already queued, see EventQueue
+        self.events.call(self.controlSpeedControl, action, device)
+
+    #-------------------------------------------------------------------------------
+    def controlSpeedControl(self, action, device):
+        trace = self.trace
+        if trace:
+            trace.record('action', kind='speedControl', id=device.id, action=str(action.speedControlAction), value=action.actionValue)
+        perf = self.perf
+        if perf:
+            perf.timed('actionControlSpeedControl', device.name, self.handleSpeedControlAction, action, device)
+        else:
+            self.handleSpeedControlAction(action, device)
+
+    #-------------------------------------------------------------------------------
+    def actionControlDimmerRelay(self, action, device):
+        # runs after any device updates already queued, see EventQueue
+        self.events.call(self.controlDimmerRelay, action, device)
+
+    #-------------------------------------------------------------------------------
+    def controlDimmerRelay(self, action, device):
+        trace = self.trace
+        if trace:
+            trace.record('action', kind='dimmerRelay', id=device.id, action=str(action.deviceAction), value=action.actionValue)
+        perf = self.perf
+        if perf:
+            perf.timed('actionControlDimmerRelay', device.name, self.handleDimmerRelayAction, action, device)
+        else:
+            self.handleDimmerRelayAction(action, device)
+
+    #-------------------------------------------------------------------------------
+    def actionControlSensor(self, action, device):
+        # runs after any device updates already queued, see EventQueue
+        self.events.call(self.controlSensor, action, device)
+
+    #-------------------------------------------------------------------------------
+    def controlSensor(self, action, device):
+        trace = self.trace
+        if trace:
+            trace.record('action', kind='sensor', id=device.id, action=str(action.sensorAction), value=action.actionValue)
+        perf = self.perf
+        if perf:
+            perf.timed('actionControlSensor', device.name, self.handleSensorAction, action, device)
+        else:
+            self.handleSensorAction(action, device)
+
+    #-------------------------------------------------------------------------------
+    def handleSpeedControlAction(self, action, device):
         self.logger.debug("actionControlSpeedControl: "+device.name)
         devGroup = self.deviceDict[device.id]
         # TURN ON
@@ -187,7 +502,7 @@ class Plugin(indigo.PluginBase):
             self.logger.error(f'"{device.name}" {str(action.speedControlAction)} request ignored')
 
     #-------------------------------------------------------------------------------
-    def actionControlDimmerRelay(self, action, device):
+    def handleDimmerRelayAction(self, action, device):
         self.logger.debug("actionControlDimmerRelay: "+device.name)
         devGroup = self.deviceDict[device.id]
         # TURN ON
@@ -208,7 +523,7 @@ class Plugin(indigo.PluginBase):
             self.logger.debug(f'"{device.name}" {str(action.speedControlAction)} request ignored')
 
     #-------------------------------------------------------------------------------
-    def actionControlSensor(self, action, device):
+    def handleSensorAction(self, action, device):
         self.logger.debug("actionControlSensor: "+device.name)
         devGroup = self.deviceDict[device.id]
         # STATUS REQUEST
@@ -219,6 +534,77 @@ class Plugin(indigo.PluginBase):
         else:
             self.logger.debug(f'"{device.name}" {str(action.speedControlAction)} request ignored')
 
+    #-------------------------------------------------------------------------------
+    def setGroupSpeeds(self, action, dev=None, callerWaitingForResult=None):
+        # several groups in one action, e.g. from a script:
+        #   indigo.server.getPlugin(pluginId).executeAction('setGroupSpeeds', props={'targets':'Bedroom = off; Porch = 50%'})
+        return self.events.call(self.applyGroupSpeeds, action)
+
+    #-------------------------------------------------------------------------------
+    def applyGroupSpeeds(self, action):
+        trace = self.trace
+        if trace:
+            trace.record('setGroupSpeeds', targets=action.props.get('targets',''))
+        targets, errors = self.parseTargets(action.props.get('targets',''))
+        for error in errors:
+            self.logger.error(f'Set Group Speeds: {error}')
+        # one entry per fan; a fan in more than one target group gets the last target listed
+        plan = dict()
+        for devGroup, key, value in targets:
+            self.logger.info(f'"{devGroup.name}" set motor speed to {kSpeedIndex[value] if key == "speedIndex" else value}')
+            for fan in devGroup.planFans(key, value):
+                plan[fan.id] = (devGroup, fan, key, value)
+        sent = self.executePlan(plan)
+        self.logger.debug('setGroupSpeeds: %s groups, %s fans, %s commands', len(targets), len(plan), sent)
+        return sent
+
+    #-------------------------------------------------------------------------------
+    def parseTargets(self, text):
+        # "<group name or id> = <off|low|medium|high|0-3|level%>", separated by newlines or ';'
+        groupsByName = dict((devGroup.name, devGroup) for devGroup in self.deviceDict.values())
+        targets = list()
+        errors  = list()
+        if not isinstance(text, str):
+            text = ';'.join(text)
+        for item in text.replace('\n',';').split(';'):
+            if not item.strip():
+                continue
+            name, sep, value = item.rpartition('=')
+            name, value = name.strip(), value.strip().lower()
+            devGroup = groupsByName.get(name)
+            if not devGroup and name.isdigit():
+                devGroup = self.deviceDict.get(int(name))
+            if not sep or not devGroup:
+                errors.append(f'unknown group "{name or item.strip()}"')
+            elif value in kSpeedIndexNames:
+                targets.append((devGroup, 'speedIndex', kSpeedIndexNames[value]))
+            elif value.isdigit() and int(value) in kSpeedIndex:
+                targets.append((devGroup, 'speedIndex', int(value)))
+            elif value.endswith('%') and value[:-1].strip().isdigit() and int(value[:-1]) <= 100:
+                targets.append((devGroup, 'speedLevel', int(value[:-1])))
+            else:
+                errors.append(f'invalid speed "{value}" for "{name}"')
+        return targets, errors
+
+    #-------------------------------------------------------------------------------
+    def executePlan(self, plan, priority=kPriorityUser):
+        # plan is {fanId: (devGroup, fan, key, value)}; returns the number of commands sent
+        commands = [(devGroup, fan, key, value) for devGroup, fan, key, value in plan.values()
+                    if self.pending.wanted(fan, key, value)]
+        batches = dict()
+        settles = dict()
+        for devGroup, fan, key, value in commands:
+            self.pending.issue(devGroup, fan, key, value, priority)
+            batches.setdefault(devGroup, list()).append((fan, key, value))
+            # every group containing the fan waits for it, so each recomputes once
+            for other in fan.groups.values():
+                settles.setdefault(other, list()).append((fan, key, value))
+        for devGroup, settleList in settles.items():
+            devGroup.beginSettle(settleList)
+        for devGroup, batch in batches.items():
+            self.dispatcher.dispatch(devGroup, batch, priority)
+        return len(commands)
+
     #-------------------------------------------------------------------------------
     # Menu Methods
     #-------------------------------------------------------------------------------
@@ -230,16 +616,29 @@ class Plugin(indigo.PluginBase):
             self.debug = True
             self.logger.debug("Debug logging enabled")
 
+    #-------------------------------------------------------------------------------
+    def logWriteStats(self):
+        written = sum(devGroup.written for devGroup in self.deviceDict.values())
+        skipped = sum(devGroup.skipped for devGroup in self.deviceDict.values())
+        self.logger.info(f'State updates: {written} written, {skipped} skipped')
+        for devId, devGroup in self.deviceDict.items():
+            self.logger.info(f'    "{devGroup.name}": {devGroup.written} written, {devGroup.skipped} skipped')
+
+    #-------------------------------------------------------------------------------
+    def dumpPerfStats(self):
+        perf = self.perf
+        if not perf:
+            self.logger.info("Performance stats are disabled (see plugin configuration)")
+            return
+        for line in perf.summary():
+            self.logger.info(line)
+        perf.reset()
+
     #-------------------------------------------------------------------------------
     # Menu Callbacks
     #-------------------------------------------------------------------------------
     def getSpeedControlDeviceList(self, filter="", valuesDict=None, typeId="", targetId=0):
-        devList = []
-        excludeList  = [dev.id for dev in indigo.devices.iter(filter='self')]
-        for dev in indigo.devices.iter(filter='indigo.speedcontrol'):
-            if not dev.id in excludeList:
-                devList.append((dev.id, dev.name))
-        return devList
+        return self.catalog.fanList() + self.catalog.groupList(targetId)
 
 
     ###############################################################################
@@ -255,23 +654,57 @@ class Plugin(indigo.PluginBase):
 
             self.id         = device.id
             self.onLevel    = 0
+            self.settling   = dict()
+            self.settleEnd  = 0
+            self.settleJob  = None
+            self.published  = dict()
+            self.written    = 0
+            self.skipped    = 0
             self.refresh(device)
+            # states we published before a restart and the server still has needn't be
+            # rewritten; divergedFans is left out, PendingCommands doesn't survive a restart
+            for key, value in plugin.snapshot.groups.get(self.id, {}).items():
+                if key != 'divergedFans' and self.states.get(key) == value:
+                    self.published[key] = value
 
             self.fanDict    = dict()
-            for fanId in self.props.get('fans',[]):
-                self.fanDict[int(fanId)] = plugin.ControlledFan(int(fanId))
+            self.nested     = None
+            self.loadFans()
+            # the server's divergedFans may be left over from before a restart; unless it
+            # matches the live count, the first publishStates corrects it
+            if self.states.get('divergedFans') == self.divergedCount():
+                self.published['divergedFans'] = self.states['divergedFans']
+
+        #-------------------------------------------------------------------------------
+        def loadFans(self):
+            # nested groups are expanded to their leaf fans, each fan counted once;
+            # returns True if the set of fans changed
+            leafIds, nested = self.plugin.catalog.expand(int(fanId) for fanId in self.props.get('fans',[]))
+            changed = leafIds != set(self.fanDict) or nested != self.nested
+            if changed:
+                for fanId in [fanId for fanId in self.fanDict if fanId not in leafIds]:
+                    self.plugin.releaseFan(fanId, self)
+                    del self.fanDict[fanId]
+                for fanId in leafIds:
+                    if fanId not in self.fanDict:
+                        self.fanDict[fanId] = self.plugin.acquireFan(fanId, self)
+                self.nested = nested
+                for fan in self.fanDict.values():
+                    fan.ordered = None
+                self.rebuildAggregates()
+            return changed
 
         #-------------------------------------------------------------------------------
         # action methods
         #-------------------------------------------------------------------------------
-        def turnOn(self):
+        def turnOn(self, priority=kPriorityUser):
             self.logger.info(f'"{self.name}" on')
-            self.setSpeedIndex(self.onLevel)
+            self.setSpeedIndex(self.onLevel, priority)
 
         #-------------------------------------------------------------------------------
-        def turnOff(self):
+        def turnOff(self, priority=kPriorityUser):
             self.logger.info(f'"{self.name}" off')
-            self.setSpeedIndex(0)
+            self.setSpeedIndex(0, priority)
 
         #-------------------------------------------------------------------------------
         def toggle(self):
@@ -281,10 +714,9 @@ class Plugin(indigo.PluginBase):
                 self.turnOn()
 
         #-------------------------------------------------------------------------------
-        def setSpeedIndex(self, speedIndex):
+        def setSpeedIndex(self, speedIndex, priority=kPriorityUser):
             self.logger.info(f'"{self.name}" set motor speed to {kSpeedIndex[speedIndex]}')
-            for fanId, fan in self.fanDict.items():
-                fan.setSpeedIndex(speedIndex)
+            self.commandFans('speedIndex', speedIndex, self.fanDict.values(), priority)
 
         #-------------------------------------------------------------------------------
         def increaseSpeedIndex(self, value):
@@ -295,10 +727,77 @@ class Plugin(indigo.PluginBase):
             self.setSpeedIndex(min(self.speedIndex-value, 0))
 
         #-------------------------------------------------------------------------------
-        def setSpeedLevel(self, speedLevel):
+        def setSpeedLevel(self, speedLevel, priority=kPriorityUser):
             self.logger.info(f'"{self.name}" set motor speed to {speedLevel}')
-            for fanId, fan in self.fanDict.items():
-                fan.setSpeedLevel(speedLevel)
+            self.commandFans('speedLevel', speedLevel, self.fanDict.values(), priority)
+
+        #-------------------------------------------------------------------------------
+        def commandFans(self, key, value, fanList, priority=kPriorityUser):
+            self.plugin.executePlan(dict((fan.id, (self, fan, key, value)) for fan in fanList), priority)
+
+        #-------------------------------------------------------------------------------
+        def planFans(self, key, value):
+            # fans this group would command for key=value
+            return list(self.fanDict.values())
+
+        #-------------------------------------------------------------------------------
+        def commandsComplete(self, total, failed):
+            # called by the dispatcher once every fan in a group command has been sent
+            if failed:
+                self.logger.error(f'"{self.name}" {len(failed)} of {total} fan commands failed')
+                if self.settling:
+                    for fan in failed:
+                        self.settling.pop(fan.id, None)
+                    # nothing more to wait for from these fans; flush now if they were the
+                    # last, otherwise keep waiting on the rest until the deadline
+                    if not self.settling:
+                        self.settleJob = self.plugin.scheduler.cancel(self.settleJob)
+                        self.plugin.events.recompute(self)
+            else:
+                self.logger.debug('FanGroup.commandsComplete: %s sent %s fan commands', self.name, total)
+
+        #-------------------------------------------------------------------------------
+        # command settling
+        #-------------------------------------------------------------------------------
+        def beginSettle(self, commands):
+            # hold recomputes until every commanded fan reports its target (or timeout),
+            # so a group command publishes one aggregate instead of one per fan
+            if self.plugin.settleTime:
+                for fan, key, value in commands:
+                    self.settling[fan.id] = (key, value)
+                self.settleEnd = time.time() + self.plugin.settleTime
+                self.settleJob = self.plugin.scheduler.reschedule(self.settleJob, self.settleEnd, self.checkSettled)
+
+        #-------------------------------------------------------------------------------
+        def isSettling(self, fan):
+            target = self.settling.get(fan.id)
+            if target and getattr(fan, target[0]) == target[1]:
+                self.settling.pop(fan.id, None)
+            if self.settling and not self.settleExpired():
+                return True
+            self.settling.clear()
+            self.settleJob = self.plugin.scheduler.cancel(self.settleJob)
+            return False
+
+        #-------------------------------------------------------------------------------
+        def settleExpired(self):
+            # the wait counts from when the fans were asked, so while any commanded fan
+            # is still held by the rate limit or waiting to be sent, push the deadline back
+            if time.time() < self.settleEnd:
+                return False
+            if any(self.plugin.dispatcher.isQueued(fanId) for fanId in self.settling):
+                self.settleEnd = time.time() + self.plugin.settleTime
+                self.settleJob = self.plugin.scheduler.reschedule(self.settleJob, self.settleEnd, self.checkSettled)
+                return False
+            return True
+
+        #-------------------------------------------------------------------------------
+        def checkSettled(self):
+            self.settleJob = None
+            if self.settling and self.settleExpired():
+                self.logger.debug('FanGroup.checkSettled: %s timed out waiting on %s fans', self.name, len(self.settling))
+                self.settling.clear()
+                self.updateGroup()
 
         #-------------------------------------------------------------------------------
         # device updated methods
@@ -306,33 +805,136 @@ class Plugin(indigo.PluginBase):
         def refresh(self, device=None):
             if not device:
                 device  = indigo.devices[self.id]
-            self.logger.debug("FanGroup.refresh: {device.name}")
+            self.logger.debug('FanGroup.refresh: %s', device.name)
             self.device = device
             self.name   = device.name
             self.props  = device.pluginProps
             self.states = device.states
+            # forget anything the server copy no longer agrees with
+            for key in [key for key, value in self.published.items() if self.states.get(key) != value]:
+                del self.published[key]
 
         #-------------------------------------------------------------------------------
-        def fanUpdated(self, oldDev, newDev):
-            if newDev.id in self.fanDict:
-                self.logger.debug(f'FanGroup.fanUpdated: {self.name} ({newDev.name})')
-                self.fanDict[newDev.id].refresh(newDev)
-                self.updateGroup()
+        def fanUpdated(self, fan, oldIndex, oldLevel, changed):
+            # the shared fan has already been refreshed; apply its old -> new delta
+            self.logger.debug('FanGroup.fanUpdated: %s (%s)', self.name, fan.id)
+            if changed:
+                self.tallyFan(oldIndex, oldLevel, -1)
+                self.tallyFan(fan.speedIndex, fan.speedLevel, 1)
+            if self.settling:
+                if self.isSettling(fan):
+                    return
+                # settled: flush whatever was deferred while waiting
+                changed = True
+            perf = self.plugin.perf
+            if changed:
+                # once per batch of queued updates, see EventQueue.recompute
+                self.plugin.events.recompute(self)
+            elif perf:
+                perf.count('group recomputes skipped')
 
         #-------------------------------------------------------------------------------
         def updateGroup(self):
-            self.logger.debug("FanGroup.updateGroup: "+self.name)
-            fanList  = list(fan for fanId, fan in self.fanDict.items())
-            self.min = min(fan.speedIndex for fan in fanList)
-            self.max = max(fan.speedIndex for fan in fanList)
-            self.avg = int(round(float(sum(fan.speedIndex for fan in fanList))/len(fanList)))
-            self.any = any(fan.speedLevel > 0 for fan in fanList)
-            for speed in range(4):
+            perf = self.plugin.perf
+            if perf:
+                perf.timed('updateGroup', self.name, self.recomputeGroup)
+            else:
+                self.recomputeGroup()
+
+        #-------------------------------------------------------------------------------
+        def recomputeGroup(self):
+            self.logger.debug('FanGroup.updateGroup: %s', self.name)
+            fanCount = len(self.fanDict)
+            if fanCount:
+                histogram = self.histogram
+                self.min  = next(speed for speed in range(kSpeedIndexCount) if histogram[speed])
+                self.max  = next(speed for speed in reversed(range(kSpeedIndexCount)) if histogram[speed])
+                self.avg  = int(round(float(self.indexSum)/fanCount))
+                self.any  = self.onCount > 0
+                self.all  = self.min if histogram[self.min] == fanCount else None
+            else:
+                self.min = self.max = self.avg = 0
+                self.any = False
+                self.all = None
+            if self.plugin.debug:
+                self.checkAggregates()
+            perf = self.plugin.perf
+            if perf:
+                perf.timed('updateState', self.name, self.updateState)
+            else:
+                self.updateState()
+
+        #-------------------------------------------------------------------------------
+        def publishStates(self, stateList):
+            # the live divergedFans goes out with the first write after start, or after
+            # the server stopped agreeing with it
+            if 'divergedFans' not in self.published:
+                stateList = [state for state in stateList if state['key'] != 'divergedFans']
+                stateList.append({'key':'divergedFans', 'value':self.divergedCount()})
+            # only send states that differ from what was last written to the server
+            changed = [state for state in stateList
+                       if state['key'] not in self.published or self.published[state['key']] != state['value']]
+            self.skipped += len(stateList) - len(changed)
+            if changed:
+                self.written += len(changed)
+                if len(changed) == 1:
+                    self.device.updateStateOnServer(key=changed[0]['key'], value=changed[0]['value'])
+                else:
+                    self.device.updateStatesOnServer(changed)
+                for state in changed:
+                    self.published[state['key']] = state['value']
+
+        #-------------------------------------------------------------------------------
+        def divergenceChanged(self):
+            # called by PendingCommands when one of our fans starts or stops diverging
+            self.publishStates([{'key':'divergedFans', 'value':self.divergedCount()}])
+
+        #-------------------------------------------------------------------------------
+        def divergedCount(self):
+            return sum(1 for fanId in self.fanDict if self.plugin.pending.isDiverged(fanId))
+
+        #-------------------------------------------------------------------------------
+        # aggregate methods
+        #-------------------------------------------------------------------------------
+        def rebuildAggregates(self):
+            # per-speed fan counts, sum of speed indexes and number of fans running,
+            # kept current by fanUpdated so updateGroup never walks the fan list
+            self.histogram  = [0]*kSpeedIndexCount
+            self.indexSum   = 0
+            self.onCount    = 0
+            for fanId, fan in self.fanDict.items():
+                self.tallyFan(fan.speedIndex, fan.speedLevel, 1)
+
+        #-------------------------------------------------------------------------------
+        def tallyFan(self, speedIndex, speedLevel, count):
+            self.histogram[speedIndex] += count
+            self.indexSum += speedIndex*count
+            if speedLevel > 0:
+                self.onCount += count
+
+        #-------------------------------------------------------------------------------
+        def checkAggregates(self):
+            # debug only: compare incremental aggregates against a full recompute
+            fanList = list(self.fanDict.values())
+            if not fanList:
+                return
+            expected = dict(
+                min = min(fan.speedIndex for fan in fanList),
+                max = max(fan.speedIndex for fan in fanList),
+                avg = int(round(float(sum(fan.speedIndex for fan in fanList))/len(fanList))),
+                any = any(fan.speedLevel > 0 for fan in fanList),
+                all = None,
+                )
+            for speed in range(kSpeedIndexCount):
                 if all(fan.speedIndex == speed for fan in fanList):
-                    self.all = speed
+                    expected['all'] = speed
                     break
-                self.all = None
-            self.updateState()
+            actual = dict((key, getattr(self, key)) for key in expected)
+            if actual != expected:
+                self.logger.error(f'"{self.name}" aggregate mismatch {actual}, expected {expected}; rebuilding')
+                self.rebuildAggregates()
+                for key, value in expected.items():
+                    setattr(self, key, value)
 
         #-------------------------------------------------------------------------------
         # abstract methods
@@ -341,12 +943,10 @@ class Plugin(indigo.PluginBase):
             raise NotImplementedError
 
         #-------------------------------------------------------------------------------
-        def thermUpdated(self, oldDev, newDev):
-            pass
-
-        #-------------------------------------------------------------------------------
-        def loopAction(self):
-            pass
+        def stop(self):
+            self.settleJob = self.plugin.scheduler.cancel(self.settleJob)
+            for fanId in self.fanDict:
+                self.plugin.releaseFan(fanId, self)
 
     ###############################################################################
     class GroupRelay(FanGroup):
@@ -362,7 +962,7 @@ class Plugin(indigo.PluginBase):
 
         #-------------------------------------------------------------------------------
         def updateState(self):
-            self.logger.debug("GroupRelay.updateState: "+self.name)
+            self.logger.debug('GroupRelay.updateState: %s', self.name)
             if self.logic == "any":
                 self.onState = self.any
             elif self.logic == "avg":
@@ -373,7 +973,7 @@ class Plugin(indigo.PluginBase):
                 self.onState = self.max >= self.onLevel
             elif self.logic == "all":
                 self.onState = self.all == self.onLevel
-            self.device.updateStateOnServer(key='onOffState', value=self.onState)
+            self.publishStates([{'key':'onOffState', 'value':self.onState}])
 
     ###############################################################################
     class GroupSpeedcontrol(FanGroup):
@@ -388,7 +988,7 @@ class Plugin(indigo.PluginBase):
 
         #-------------------------------------------------------------------------------
         def updateState(self):
-            self.logger.debug("GroupSpeedcontrol.updateState: "+self.name)
+            self.logger.debug('GroupSpeedcontrol.updateState: %s', self.name)
             if self.logic == "avg":
                 self.speedIndex = self.avg
             elif self.logic == "min":
@@ -397,8 +997,8 @@ class Plugin(indigo.PluginBase):
                 self.speedIndex = self.max
             elif self.logic == "all":
                 self.speedIndex = self.all
-            self.onstate = self.any
-            self.device.updateStateOnServer(key='speedIndex', value=self.speedIndex)
+            self.onState = self.any
+            self.publishStates([{'key':'speedIndex', 'value':self.speedIndex}])
 
     ###############################################################################
     class GroupThermAssist(FanGroup):
@@ -416,92 +1016,1181 @@ class Plugin(indigo.PluginBase):
             self.onOverride  = self.props['onOverride']
             self.offOverride = self.props['onOverride']
             self.tempFreq    = int(self.props['tempFreq'])
-            self.nextTemp    = time.time() + self.tempFreq
-            self.therm       = plugin.MonitoredThermostat(self.thermId)
+            self.adaptive    = self.props.get('adaptivePoll',False)
+            self.tempFreqMax = int(self.props.get('tempFreqMax',1800))
+            self.tempFreqMin = min(int(self.props.get('tempFreqMin',60)), self.tempFreqMax)
+            self.crossing    = None
             self.onState     = device.onState
+            self.therm       = plugin.acquireThermostat(self.thermId, self)
+            self.therm.schedulePoll()
 
         #-------------------------------------------------------------------------------
         def updateState(self):
-            self.logger.debug("GroupThermAssist.updateState: "+self.name)
+            self.logger.debug('GroupThermAssist.updateState: %s', self.name)
             coolDelta   = self.therm.temp - self.therm.coolSet
             heatDelta   = self.therm.heatSet - self.therm.temp
             tempDelta   = max([coolDelta,heatDelta])
+            deltaRate   = self.therm.trend() * (1 if coolDelta >= heatDelta else -1)
             onLimit     = tempDelta > self.onThresh
             offLimit    = tempDelta > self.offThresh and self.device.onState
             onFlag      = (self.therm.coolOn or self.therm.heatOn) and (onLimit or offLimit)
 
-            if onFlag and (not self.onState):
-                self.onState = True
-                self.device.updateStateOnServer(key='onOffState', value=self.onState)
-                self.turnOn()
-                self.nextTemp = time.time() + self.tempFreq
-            elif (not onFlag) and self.onState:
-                self.onState = False
-                self.device.updateStateOnServer(key='onOffState', value=self.onState)
-                self.turnOff()
+            switched     = bool(onFlag) != bool(self.onState)
+            self.onState = bool(onFlag)
+
+            self.crossing = None
+            if self.therm.coolOn or self.therm.heatOn:
+                self.crossing = self.predictCrossing(tempDelta, deltaRate)
+            crossingText = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.crossing)) if self.crossing else ""
+            # one server write for both states
+            self.publishStates([{'key':'onOffState', 'value':self.onState},
+                                {'key':'predictedCrossing', 'value':crossingText}])
+
+            if switched:
+                if self.onState:
+                    self.turnOn(kPriorityAutomation)
+                else:
+                    self.turnOff(kPriorityAutomation)
+                self.therm.schedulePoll()
 
         #-------------------------------------------------------------------------------
-        def thermUpdated(self, oldDev, newDev):
-            if newDev.id == self.thermId:
-                self.logger.debug(f'GroupThermAssist.thermUpdated: {self.name} ({newDev.name})')
-                self.therm.refresh(newDev)
-                self.updateState()
+        def predictCrossing(self, tempDelta, deltaRate):
+            # when will tempDelta reach the threshold that would change our state?
+            threshold = self.offThresh if self.onState else self.onThresh
+            if deltaRate:
+                seconds = (threshold - tempDelta) / deltaRate
+                if seconds > 0:
+                    return time.time() + seconds
+            return None
+
+        #-------------------------------------------------------------------------------
+        def pollInterval(self):
+            # seconds between thermostat polls wanted by this group, None if no polling
+            if not self.tempFreq:
+                return None
+            if not self.adaptive:
+                return self.tempFreq if self.onState else None
+            # adaptive groups also watch for the ON threshold while the hvac is running
+            if not (self.onState or self.therm.coolOn or self.therm.heatOn):
+                return None
+            # back off to tempFreqMax unless a crossing is predicted sooner than that
+            if not self.crossing:
+                return self.tempFreqMax
+            return min(max(self.crossing - time.time(), self.tempFreqMin), self.tempFreqMax)
+
+        #-------------------------------------------------------------------------------
+        def thermUpdated(self):
+            self.logger.debug('GroupThermAssist.thermUpdated: %s (%s)', self.name, self.therm.name)
+            self.updateState()
 
         #-------------------------------------------------------------------------------
-        def loopAction(self):
-            if self.onState and self.tempFreq and (self.nextTemp < time.time()):
-                self.logger.debug("thermostat status request: "+self.therm.name)
-                indigo.device.statusRequest(self.therm.id, suppressLogging=(not self.plugin.debug))
-                self.nextTemp = time.time() + self.tempFreq
+        def stop(self):
+            self.plugin.FanGroup.stop(self)
+            self.plugin.releaseThermostat(self.thermId, self)
 
         #-------------------------------------------------------------------------------
-        def setSpeedIndex(self, speedIndex):
+        def setSpeedIndex(self, speedIndex, priority=kPriorityUser):
             self.logger.info(f'"{self.name}" set motor speed to {kSpeedIndex[speedIndex]}')
+            self.commandFans('speedIndex', speedIndex, self.planFans('speedIndex', speedIndex), priority)
+
+        #-------------------------------------------------------------------------------
+        def planFans(self, key, value):
+            if key != 'speedIndex':
+                return list(self.fanDict.values())
+            fanList = list()
             for fanId, fan in self.fanDict.items():
-                if (    speedIndex and (self.onOverride or not fan.speedIndex)) or \
-                   (not speedIndex and (self.offOverride or    fan.speedIndex == self.onLevel)):
-                    fan.setSpeedIndex(speedIndex)
+                if (    value and (self.onOverride or not fan.speedIndex)) or \
+                   (not value and (self.offOverride or    fan.speedIndex == self.onLevel)):
+                    fanList.append(fan)
+            return fanList
 
     ###############################################################################
     class ControlledFan(object):
+        # shared by every group containing the fan, see Plugin.acquireFan
+        __slots__ = ('id', 'speedIndex', 'speedLevel', 'groups', 'ordered')
 
         #-------------------------------------------------------------------------------
-        def __init__(self, fanId):
+        def __init__(self, fanId, projection=None):
             self.id         = fanId
-            self.refresh()
+            self.groups     = dict()
+            self.ordered    = None
+            self.speedIndex = None
+            self.speedLevel = 0
+            if projection:
+                self.speedIndex, self.speedLevel = projection
+            else:
+                self.refresh()
+
+        #-------------------------------------------------------------------------------
+        @staticmethod
+        def project(fan):
+            # the only fields of a speedcontrol device that groups look at
+            return (fan.speedIndex, fan.speedLevel)
+
+        #-------------------------------------------------------------------------------
+        def orderedGroups(self):
+            # a group nests fewer groups than any group containing it, so this is topological
+            if self.ordered is None:
+                self.ordered = sorted(self.groups.values(), key=lambda devGroup: len(devGroup.nested))
+            return self.ordered
 
         #-------------------------------------------------------------------------------
         def refresh(self, fan=None):
+            # returns True if anything group aggregates depend on has changed
             if not fan:
                 fan = indigo.devices[self.id]
+            changed = (fan.speedIndex != self.speedIndex) or ((fan.speedLevel > 0) != (self.speedLevel > 0))
             self.speedIndex = fan.speedIndex
             self.speedLevel = fan.speedLevel
+            return changed
 
         #-------------------------------------------------------------------------------
-        def setSpeedIndex(self, speedIndex):
-            if self.speedIndex != speedIndex:
-                indigo.speedcontrol.setSpeedIndex(self.id, value=speedIndex)
-
-        #-------------------------------------------------------------------------------
-        def setSpeedLevel(self, speedLevel):
-            if self.speedLevel != speedLevel:
-                indigo.speedcontrol.setSpeedLevel(self.id, value=speedLevel)
+        def command(self, key, value):
+            # callers skip fans already at the target (see PendingCommands.wanted)
+            if key == 'speedIndex':
+                indigo.speedcontrol.setSpeedIndex(self.id, value=value)
+            elif key == 'speedLevel':
+                indigo.speedcontrol.setSpeedLevel(self.id, value=value)
 
     ###############################################################################
     class MonitoredThermostat(object):
 
         #-------------------------------------------------------------------------------
-        def __init__(self, thermId):
+        def __init__(self, thermId, plugin):
+            self.plugin     = plugin
+            self.logger     = plugin.logger
             self.id         = thermId
+            self.groups     = dict()
+            self.samples    = deque(maxlen=kTrendSamples)
+            self.pollStart  = None
+            self.pollJob    = None
+            # resume the trend and poll schedule from before a restart
+            saved = plugin.snapshot.thermostats.pop(thermId, None)
+            if saved:
+                oldest = time.time() - kSnapshotMaxAge
+                self.samples.extend(tuple(sample) for sample in saved['samples'] if sample[0] > oldest)
+                if saved['pollStart'] and saved['pollStart'] > oldest:
+                    self.pollStart = saved['pollStart']
             self.refresh()
 
+        #-------------------------------------------------------------------------------
+        @staticmethod
+        def project(therm):
+            # the only fields of a thermostat that assist groups look at
+            return (therm.temperatures[0], therm.coolSetpoint, therm.heatSetpoint, therm.coolIsOn, therm.heatIsOn)
+
         #-------------------------------------------------------------------------------
         def refresh(self, therm=None):
             if not therm:
                 therm = indigo.devices[self.id]
             self.name       = therm.name
-            self.temp       = therm.temperatures[0]
-            self.coolSet    = therm.coolSetpoint
-            self.heatSet    = therm.heatSetpoint
-            self.coolOn     = therm.coolIsOn
-            self.heatOn     = therm.heatIsOn
+            self.projection = self.project(therm)
+            self.temp, self.coolSet, self.heatSet, self.coolOn, self.heatOn = self.projection
+            if not self.samples or self.samples[-1][1] != self.temp:
+                self.samples.append((time.time(), self.temp))
+
+        #-------------------------------------------------------------------------------
+        def trend(self):
+            # least-squares slope of recent temperatures in degrees/second; the latest
+            # reading is repeated at the current time so a stale trend decays toward zero
+            points = list(self.samples)
+            now = time.time()
+            if points and now > points[-1][0]:
+                points.append((now, points[-1][1]))
+            if len(points) < 2:
+                return 0.0
+            meanT = sum(t for t, temp in points) / len(points)
+            meanY = sum(temp for t, temp in points) / len(points)
+            spread = sum((t - meanT)**2 for t, temp in points)
+            if not spread:
+                return 0.0
+            return sum((t - meanT)*(temp - meanY) for t, temp in points) / spread
+
+        #-------------------------------------------------------------------------------
+        def thermUpdated(self, therm):
+            # parse the update once and hand it to every subscribed group
+            self.refresh(therm)
+            for groupId, devGroup in list(self.groups.items()):
+                devGroup.thermUpdated()
+            # fresh data, so count the next poll from now
+            self.schedulePoll(restart=True)
+
+        #-------------------------------------------------------------------------------
+        def schedulePoll(self, restart=False):
+            # poll at the shortest interval wanted by any subscribed group
+            intervals = [devGroup.pollInterval() for devGroup in self.groups.values()]
+            intervals = [interval for interval in intervals if interval]
+            if intervals:
+                if restart or not self.pollStart:
+                    self.pollStart = time.time()
+                self.pollJob = self.plugin.scheduler.reschedule(self.pollJob, self.pollStart+min(intervals), self.poll)
+            else:
+                self.pollJob = self.plugin.scheduler.cancel(self.pollJob)
+                self.pollStart = None
+
+        #-------------------------------------------------------------------------------
+        def poll(self):
+            self.pollJob = None
+            self.logger.debug('thermostat status request: %s', self.name)
+            perf = self.plugin.perf
+            if perf:
+                perf.timed('device.statusRequest', None, indigo.device.statusRequest, self.id, suppressLogging=(not self.plugin.debug))
+            else:
+                indigo.device.statusRequest(self.id, suppressLogging=(not self.plugin.debug))
+            self.schedulePoll(restart=True)
+
+        #-------------------------------------------------------------------------------
+        def stop(self):
+            self.pollJob = self.plugin.scheduler.cancel(self.pollJob)
+
+    ###############################################################################
+    class CommandDispatcher(object):
+        # Sends fan commands for group actions. Serial by default; in concurrent mode
+        # commands run on a thread pool shared by all groups (global limit) with at most
+        # perGroup commands of any one group in flight, so callbacks return immediately;
+        # completion is handed back to the plugin thread through the scheduler.
+        # When rate limited, commands first wait in a priority queue (one entry per fan,
+        # latest wins) and are released by a token bucket of rate/sec and burst size.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin):
+            self.plugin     = plugin
+            self.logger     = plugin.logger
+            self.lock       = threading.Lock()
+            self.executor   = None
+            self.enabled    = False
+            self.threads    = 4
+            self.perGroup   = 2
+            self.queues     = dict()
+            self.running    = dict()
+            self.unsent     = dict()
+            self.rate       = 0.0
+            self.burst      = 10.0
+            self.tokens     = 0.0
+            self.refilled   = 0.0
+            self.waiting    = dict()
+            self.heap       = list()
+            self.sequence   = itertools.count()
+            self.releaseJob = None
+
+        #-------------------------------------------------------------------------------
+        def configure(self, prefs):
+            enabled  = bool(prefs.get('concurrentDispatch',False))
+            threads  = int(prefs.get('dispatchThreads',4))
+            perGroup = int(prefs.get('dispatchPerGroup',2))
+            rate     = float(prefs.get('commandRate',5)) if prefs.get('rateLimit',False) else 0.0
+            burst    = float(prefs.get('commandBurst',10))
+            with self.lock:
+                if rate and not self.rate:
+                    self.tokens   = burst
+                    self.refilled = time.time()
+                self.rate  = rate
+                self.burst = burst
+            if self.executor and (not enabled or threads != self.threads):
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            self.enabled  = enabled
+            self.threads  = threads
+            self.perGroup = perGroup
+            if self.enabled and not self.executor:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='FanGroupDispatch')
+            # anything still waiting goes out now if the limit was turned off; prefs are
+            # closed on Indigo's callback thread, so leave the sending to the plugin thread
+            with self.lock:
+                if self.waiting:
+                    self.releaseJob = self.plugin.scheduler.reschedule(self.releaseJob, time.time(), self.releaseDue)
+
+        #-------------------------------------------------------------------------------
+        def stop(self):
+            with self.lock:
+                self.releaseJob = self.plugin.scheduler.cancel(self.releaseJob)
+                self.waiting.clear()
+                self.heap = list()
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+        #-------------------------------------------------------------------------------
+        def dispatch(self, group, commands, priority=kPriorityUser):
+            batch = self.Batch(group, len(commands))
+            if self.rate:
+                self.enqueue(batch, commands, priority)
+                self.releaseDue()
+            else:
+                self.submit(batch, commands)
+
+        #-------------------------------------------------------------------------------
+        def isQueued(self, fanId):
+            # True while a command for the fan is rate limited, waiting for a dispatch
+            # thread or being sent, i.e. the fan can't have answered it yet
+            return fanId in self.waiting or fanId in self.unsent
+
+        #-------------------------------------------------------------------------------
+        def enqueue(self, batch, commands, priority):
+            superseded = list()
+            with self.lock:
+                now = time.time()
+                for fan, key, value in commands:
+                    entry = self.Entry(batch, fan, key, value, priority, now)
+                    old = self.waiting.get(fan.id)
+                    if old:
+                        # latest command for the fan wins, but keeps the better priority and wait time
+                        old.cancelled  = True
+                        entry.priority = min(priority, old.priority)
+                        entry.queued   = old.queued
+                        superseded.append(old)
+                    self.waiting[fan.id] = entry
+                    heapq.heappush(self.heap, (entry.priority, next(self.sequence), entry))
+                depth = len(self.waiting)
+            perf = self.plugin.perf
+            if perf:
+                perf.peak('command queue peak depth', depth)
+                if superseded:
+                    perf.count('queued commands coalesced', len(superseded))
+            for old in superseded:
+                if old.batch.done(old.fan, True):
+                    old.batch.complete()
+
+        #-------------------------------------------------------------------------------
+        def releaseDue(self):
+            # send as many queued commands as the bucket allows, then wait for the next token
+            released = list()
+            with self.lock:
+                self.releaseJob = self.plugin.scheduler.cancel(self.releaseJob)
+                now = time.time()
+                if self.rate:
+                    self.tokens   = min(self.burst, self.tokens + (now - self.refilled)*self.rate)
+                    self.refilled = now
+                while self.heap and (self.heap[0][2].cancelled or self.tokens >= 1 or not self.rate):
+                    priority, sequence, entry = heapq.heappop(self.heap)
+                    if entry.cancelled:
+                        continue
+                    del self.waiting[entry.fan.id]
+                    self.tokens -= 1
+                    released.append(entry)
+                if self.waiting:
+                    self.releaseJob = self.plugin.scheduler.schedule(now + (1 - self.tokens)/self.rate, self.releaseDue)
+                elif not self.rate:
+                    self.tokens = 0.0
+            perf = self.plugin.perf
+            for entry in released:
+                if perf:
+                    perf.record('command queue wait', None, now - entry.queued)
+                self.submit(entry.batch, [(entry.fan, entry.key, entry.value)])
+
+        #-------------------------------------------------------------------------------
+        def submit(self, batch, commands):
+            group = batch.group
+            if not self.executor:
+                for fan, key, value in commands:
+                    if self.send(batch, fan, key, value):
+                        batch.complete()
+                return
+            with self.lock:
+                queue = self.queues.setdefault(group.id, deque())
+                queue.extend((batch, fan, key, value) for fan, key, value in commands)
+                for fan, key, value in commands:
+                    self.unsent[fan.id] = self.unsent.get(fan.id, 0) + 1
+                runners = min(self.perGroup - self.running.get(group.id, 0), len(queue))
+                self.running[group.id] = self.running.get(group.id, 0) + max(runners, 0)
+            for i in range(runners):
+                self.executor.submit(self.runQueue, group.id)
+
+        #-------------------------------------------------------------------------------
+        def runQueue(self, groupId):
+            while True:
+                with self.lock:
+                    queue = self.queues.get(groupId)
+                    if not queue:
+                        self.running[groupId] -= 1
+                        if not self.running[groupId]:
+                            del self.running[groupId]
+                            self.queues.pop(groupId, None)
+                        return
+                    batch, fan, key, value = queue.popleft()
+                try:
+                    completed = self.send(batch, fan, key, value)
+                finally:
+                    with self.lock:
+                        self.unsent[fan.id] -= 1
+                        if not self.unsent[fan.id]:
+                            del self.unsent[fan.id]
+                if completed:
+                    # settle state belongs to the plugin thread, hand completion back to it
+                    self.plugin.scheduler.schedule(time.time(), batch.complete)
+
+        #-------------------------------------------------------------------------------
+        def send(self, batch, fan, key, value):
+            # returns True for the command that completes the batch
+            if not self.plugin.pending.isCurrent(fan, key, value):
+                # superseded (or already reached) while waiting in the queue
+                perf = self.plugin.perf
+                if perf:
+                    perf.count('fan commands dropped before send')
+                return batch.done(fan, True)
+            try:
+                perf = self.plugin.perf
+                if perf:
+                    perf.timed(kCommandNames[key], batch.group.name, fan.command, key, value)
+                else:
+                    fan.command(key, value)
+                ok = True
+            except Exception as e:
+                self.logger.debug(f'CommandDispatcher.send: fan {fan.id} {key}={value} failed: {e}')
+                ok = False
+            return batch.done(fan, ok)
+
+        ###############################################################################
+        class Entry(object):
+            __slots__ = ('batch', 'fan', 'key', 'value', 'priority', 'queued', 'cancelled')
+
+            #-------------------------------------------------------------------------------
+            def __init__(self, batch, fan, key, value, priority, queued):
+                self.batch      = batch
+                self.fan        = fan
+                self.key        = key
+                self.value      = value
+                self.priority   = priority
+                self.queued     = queued
+                self.cancelled  = False
+
+        ###############################################################################
+        class Batch(object):
+
+            #-------------------------------------------------------------------------------
+            def __init__(self, group, total):
+                self.group      = group
+                self.total      = total
+                self.count      = 0
+                self.failed     = list()
+                self.lock       = threading.Lock()
+
+            #-------------------------------------------------------------------------------
+            def done(self, fan, ok):
+                # returns True for the call that completes the batch
+                with self.lock:
+                    self.count += 1
+                    if not ok:
+                        self.failed.append(fan)
+                    return self.count == self.total
+
+            #-------------------------------------------------------------------------------
+            def complete(self):
+                self.group.commandsComplete(self.total, self.failed)
+
+    ###############################################################################
+    class PendingCommands(object):
+        # The last value commanded for each fan, until the fan reports it. A repeat
+        # of the pending command is coalesced, a different one supersedes it, and a
+        # command the fan hasn't reported after kCommandTimeout is resent with a
+        # doubling timeout, then given up. Fans past their first timeout are
+        # "diverged" and counted in each group's divergedFans state.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin):
+            self.plugin     = plugin
+            self.logger     = plugin.logger
+            self.intents    = dict()
+
+        #-------------------------------------------------------------------------------
+        def wanted(self, fan, key, value):
+            # returns True if a command is needed to bring the fan to key=value
+            intent = self.intents.get(fan.id)
+            if intent and not intent.failed:
+                if intent.key == key and intent.value == value:
+                    perf = self.plugin.perf
+                    if perf:
+                        perf.count('fan commands coalesced')
+                    return False
+                return True
+            return getattr(fan, key) != value
+
+        #-------------------------------------------------------------------------------
+        def issue(self, devGroup, fan, key, value, priority=kPriorityUser):
+            old = self.intents.get(fan.id)
+            if old:
+                old.job = self.plugin.scheduler.cancel(old.job)
+                perf = self.plugin.perf
+                if perf and not old.failed:
+                    perf.count('fan commands superseded')
+            intent = self.intents[fan.id] = self.Intent(devGroup.id, key, value, priority)
+            intent.job = self.plugin.scheduler.schedule(intent.issued+kCommandTimeout, lambda: self.expired(fan, intent))
+            if old and old.attempts:
+                self.notify(fan)
+
+        #-------------------------------------------------------------------------------
+        def isCurrent(self, fan, key, value):
+            intent = self.intents.get(fan.id)
+            return bool(intent) and intent.key == key and intent.value == value
+
+        #-------------------------------------------------------------------------------
+        def reachedBy(self, fanId, dev):
+            # True if the device update shows the value last commanded for the fan
+            intent = self.intents.get(fanId)
+            return bool(intent) and getattr(dev, intent.key, None) == intent.value
+
+        #-------------------------------------------------------------------------------
+        def isDiverged(self, fanId):
+            intent = self.intents.get(fanId)
+            return bool(intent) and intent.attempts > 0
+
+        #-------------------------------------------------------------------------------
+        def fanUpdated(self, fan):
+            intent = self.intents.get(fan.id)
+            if intent and getattr(fan, intent.key) == intent.value:
+                intent.job = self.plugin.scheduler.cancel(intent.job)
+                del self.intents[fan.id]
+                if intent.attempts:
+                    self.logger.debug('PendingCommands.fanUpdated: fan %s reached %s=%s', fan.id, intent.key, intent.value)
+                    self.notify(fan)
+
+        #-------------------------------------------------------------------------------
+        def expired(self, fan, intent):
+            intent.job = None
+            if self.intents.get(fan.id) is not intent:
+                return
+            if self.plugin.dispatcher.isQueued(fan.id):
+                # still rate limited or waiting to be sent, the fan hasn't been asked yet
+                intent.job = self.plugin.scheduler.schedule(time.time() + kCommandTimeout, lambda: self.expired(fan, intent))
+                return
+            if intent.attempts >= kCommandRetries:
+                intent.failed = True
+                self.logger.warning(f'fan {fan.id} did not report {intent.key}={intent.value} after {intent.attempts+1} attempts')
+                return
+            intent.attempts += 1
+            if intent.attempts == 1:
+                self.notify(fan)
+            perf = self.plugin.perf
+            if perf:
+                perf.count('fan commands retried')
+            self.logger.debug('PendingCommands.expired: resending %s=%s to fan %s', intent.key, intent.value, fan.id)
+            intent.job = self.plugin.scheduler.schedule(time.time() + kCommandTimeout*2**intent.attempts,
+                                                        lambda: self.expired(fan, intent))
+            devGroup = fan.groups.get(intent.groupId) or next(iter(fan.groups.values()))
+            self.plugin.dispatcher.dispatch(devGroup, [(fan, intent.key, intent.value)], intent.priority)
+
+        #-------------------------------------------------------------------------------
+        def notify(self, fan):
+            for devGroup in list(fan.groups.values()):
+                devGroup.divergenceChanged()
+
+        #-------------------------------------------------------------------------------
+        def release(self, fanId):
+            intent = self.intents.pop(fanId, None)
+            if intent:
+                intent.job = self.plugin.scheduler.cancel(intent.job)
+
+        #-------------------------------------------------------------------------------
+        def stop(self):
+            for fanId in list(self.intents):
+                self.release(fanId)
+
+        ###############################################################################
+        class Intent(object):
+            __slots__ = ('groupId', 'key', 'value', 'priority', 'issued', 'attempts', 'failed', 'job')
+
+            #-------------------------------------------------------------------------------
+            def __init__(self, groupId, key, value, priority):
+                self.groupId    = groupId
+                self.key        = key
+                self.value      = value
+                self.priority   = priority
+                self.issued     = time.time()
+                self.attempts   = 0
+                self.failed     = False
+                self.job        = None
+
+    ###############################################################################
+    class Snapshot(object):
+        # Warm-restart state kept in a JSON file next to the plugin prefs: the states
+        # each group last published and each thermostat's temperature samples and
+        # poll schedule. Fan speeds aren't saved, startup reads them all in one pass.
+        # Indigo stops every device before shutdown, so stopped groups and thermostats
+        # are kept here until the next save.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin):
+            self.plugin         = plugin
+            self.logger         = plugin.logger
+            self.path           = os.path.join(indigo.server.getInstallFolderPath(), 'Preferences', 'Plugins',
+                                               f'{plugin.pluginId}.snapshot.json')
+            self.groups         = dict()
+            self.thermostats    = dict()
+
+        #-------------------------------------------------------------------------------
+        def load(self):
+            try:
+                with open(self.path) as snapshotFile:
+                    data = json.load(snapshotFile)
+            except FileNotFoundError:
+                return
+            except Exception as e:
+                self.logger.warning(f'unable to read snapshot {self.path}: {e}')
+                return
+            if data.get('version') != kSnapshotVersion:
+                self.logger.debug(f'Snapshot.load: ignoring version {data.get("version")}')
+                return
+            self.groups      = dict((int(devId), states) for devId, states in data.get('groups',{}).items())
+            self.thermostats = dict((int(thermId), saved) for thermId, saved in data.get('thermostats',{}).items())
+            self.logger.debug(f'Snapshot.load: {len(self.groups)} groups, {len(self.thermostats)} thermostats, '
+                              f'{int(time.time()-data.get("saved",0))} seconds old')
+
+        #-------------------------------------------------------------------------------
+        def keepGroup(self, devGroup):
+            self.groups[devGroup.id] = dict(devGroup.published)
+
+        #-------------------------------------------------------------------------------
+        def keepThermostat(self, therm):
+            self.thermostats[therm.id] = {'samples':list(therm.samples), 'pollStart':therm.pollStart}
+
+        #-------------------------------------------------------------------------------
+        def save(self):
+            for devGroup in list(self.plugin.deviceDict.values()):
+                self.keepGroup(devGroup)
+            for therm in list(self.plugin.thermostats.values()):
+                self.keepThermostat(therm)
+            data = {
+                'version':      kSnapshotVersion,
+                'saved':        time.time(),
+                'groups':       dict(self.groups),
+                'thermostats':  dict(self.thermostats),
+                }
+            try:
+                with open(self.path+'.tmp', 'w') as snapshotFile:
+                    json.dump(data, snapshotFile)
+                os.replace(self.path+'.tmp', self.path)
+            except Exception as e:
+                self.logger.warning(f'unable to write snapshot {self.path}: {e}')
+
+    ###############################################################################
+    class TraceRecorder(object):
+        # Appends the callbacks that drive group logic (watched fan and thermostat
+        # updates with only their projected fields, actions, group start/stop and
+        # timers) to a JSON-lines file for tools/replay.py. Each file starts with a
+        # header and the running groups, so a rotated file replays on its own.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin, maxBytes):
+            self.plugin     = plugin
+            self.logger     = plugin.logger
+            self.maxBytes   = maxBytes
+            self.path       = os.path.join(indigo.server.getInstallFolderPath(), 'Preferences', 'Plugins',
+                                           f'{plugin.pluginId}.trace.jsonl')
+            self.lock       = threading.RLock()
+            self.traceFile  = None
+            self.size       = 0
+            self.opening    = False
+            self.open(os.path.exists(self.path) and os.path.getsize(self.path) < maxBytes)
+            self.logger.info(f'Recording event trace to {self.path}')
+
+        #-------------------------------------------------------------------------------
+        def open(self, append):
+            with self.lock:
+                try:
+                    self.traceFile = open(self.path, 'a' if append else 'w')
+                except Exception as e:
+                    self.logger.warning(f'unable to open trace {self.path}: {e}')
+                    return
+                self.size = self.traceFile.tell()
+                # the header always goes in whole, even past maxBytes
+                self.opening = True
+                self.record('trace', version=kTraceVersion, pluginVersion=self.plugin.pluginVersion,
+                            prefs=dict(self.plugin.pluginPrefs))
+                for devGroup in list(self.plugin.deviceDict.values()):
+                    self.recordGroup(devGroup)
+                self.opening = False
+
+        #-------------------------------------------------------------------------------
+        def record(self, event, **fields):
+            fields['t'] = round(time.time(), 3)
+            fields['e'] = event
+            line = json.dumps(fields, separators=(',',':'), default=self.encode) + '\n'
+            with self.lock:
+                if not self.traceFile:
+                    return
+                if self.size + len(line) > self.maxBytes and not self.opening:
+                    self.rotate()
+                    if not self.traceFile:
+                        return
+                self.traceFile.write(line)
+                self.traceFile.flush()
+                self.size += len(line)
+
+        #-------------------------------------------------------------------------------
+        def recordGroup(self, devGroup):
+            fanNames = self.plugin.catalog.fans
+            therm = getattr(devGroup, 'therm', None)
+            self.record('start', id=devGroup.id, name=devGroup.name, type=devGroup.device.deviceTypeId,
+                        props=dict(devGroup.props), states=dict(devGroup.states),
+                        fans=dict((fanId, [fanNames.get(fanId,''), fan.speedIndex, fan.speedLevel])
+                                  for fanId, fan in devGroup.fanDict.items()),
+                        therm=[therm.id, therm.name] + list(therm.projection) if therm else None)
+
+        #-------------------------------------------------------------------------------
+        def rotate(self):
+            # trace.jsonl -> trace.jsonl.1 -> trace.jsonl.2 ...
+            self.traceFile.close()
+            self.traceFile = None
+            for index in reversed(range(1, kTraceFiles)):
+                older = f'{self.path}.{index-1}' if index > 1 else self.path
+                if os.path.exists(older):
+                    os.replace(older, f'{self.path}.{index}')
+            self.open(False)
+
+        #-------------------------------------------------------------------------------
+        def encode(self, value):
+            if isinstance(value, indigo.List):
+                return list(value)
+            if isinstance(value, indigo.Dict):
+                return dict(value)
+            return str(value)
+
+        #-------------------------------------------------------------------------------
+        def close(self):
+            with self.lock:
+                if self.traceFile:
+                    self.traceFile.close()
+                    self.traceFile = None
+
+    ###############################################################################
+    class EventQueue(object):
+        # Device updates, actions and device start/stop handed from Indigo's callback
+        # thread to runConcurrentThread, so callbacks return at once. An update for a
+        # device that is still waiting replaces it (latest wins, keeping the oldest
+        # oldDev), unless the waiting one shows a fan reaching its commanded value
+        # (see PendingCommands). Everything else is a barrier that updates are never merged across,
+        # so every group sees its events in the order they arrived. While a batch is
+        # drained, groups whose fans changed are marked and recomputed once, at the
+        # end of the batch or before the next barrier. Once kEventQueueLimit updates
+        # are waiting, further fan and thermostat updates only note the device id and
+        # the device is re-read from the server when the queue is drained, so the
+        # queue stays bounded without holding up Indigo. Until the thread starts,
+        # after it stops, or with the queue turned off, callbacks run inline.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin):
+            self.plugin     = plugin
+            self.logger     = plugin.logger
+            self.lock       = threading.Lock()
+            self.stopped    = threading.Condition(self.lock)
+            self.enabled    = True
+            self.running    = False
+            self.stopping   = None
+            self.entries    = deque()
+            self.latest     = dict()
+            self.overflow   = dict()
+            self.dirty      = None
+
+        #-------------------------------------------------------------------------------
+        def configure(self, prefs):
+            self.enabled = bool(prefs.get('eventQueue',True))
+
+        #-------------------------------------------------------------------------------
+        def start(self):
+            with self.lock:
+                self.running = True
+
+        #-------------------------------------------------------------------------------
+        def stop(self):
+            # anything still queued runs now; callbacks arriving meanwhile wait for it
+            # to finish, then run inline
+            with self.lock:
+                self.running  = False
+                self.stopping = threading.current_thread()
+            try:
+                self.drain()
+            finally:
+                with self.lock:
+                    self.stopping = None
+                    self.stopped.notify_all()
+
+        #-------------------------------------------------------------------------------
+        def waiting(self):
+            return bool(self.entries or self.overflow)
+
+        #-------------------------------------------------------------------------------
+        def post(self, devId, oldDev, newDev):
+            with self.lock:
+                if self.accepting():
+                    pending = self.plugin.pending
+                    entry = self.latest.get(devId)
+                    # an update showing a commanded value was reached is kept, so the
+                    # pending command is cleared rather than resent
+                    if entry and not pending.reachedBy(devId, entry.args[1]):
+                        entry.args = (entry.args[0], newDev)
+                        perf = self.plugin.perf
+                        if perf:
+                            perf.count('events merged')
+                    elif (len(self.entries) < kEventQueueLimit or pending.reachedBy(devId, newDev)
+                            or not (devId in self.plugin.fans or devId in self.plugin.thermostats)):
+                        entry = self.latest[devId] = self.Entry(devId, self.plugin.processDeviceUpdated, (oldDev, newDev))
+                        self.append(entry)
+                    elif devId not in self.overflow:
+                        self.overflow[devId] = True
+                        perf = self.plugin.perf
+                        if perf:
+                            perf.count('event queue overflows')
+                    return
+            self.plugin.processDeviceUpdated(oldDev, newDev)
+
+        #-------------------------------------------------------------------------------
+        def call(self, func, *args):
+            # returns func's result when run inline, None once queued
+            with self.lock:
+                if self.accepting():
+                    self.spill()
+                    self.append(self.Entry(None, func, args))
+                    # later updates queue behind the barrier
+                    self.latest.clear()
+                    return None
+            return func(*args)
+
+        #-------------------------------------------------------------------------------
+        def accepting(self):
+            # lock held; False if the caller should run the event itself
+            if self.stopping and self.stopping is not threading.current_thread():
+                self.stopped.wait_for(lambda: not self.stopping)
+            return self.running and self.enabled
+
+        #-------------------------------------------------------------------------------
+        def append(self, entry):
+            # lock held
+            self.entries.append(entry)
+            perf = self.plugin.perf
+            if perf:
+                perf.count('events queued')
+                perf.peak('event queue peak depth', len(self.entries))
+            if len(self.entries) == 1:
+                self.plugin.scheduler.wake()
+
+        #-------------------------------------------------------------------------------
+        def spill(self):
+            # lock held; devices that overflowed are re-read ahead of anything queued later
+            if self.overflow:
+                self.entries.append(self.Entry(None, self.resync, (list(self.overflow),)))
+                self.overflow = dict()
+
+        #-------------------------------------------------------------------------------
+        def resync(self, devIds):
+            for devId in devIds:
+                if devId in indigo.devices:
+                    dev = indigo.devices[devId]
+                    self.plugin.catalog.rename(dev)
+                    self.plugin.processDeviceUpdated(dev, dev)
+
+        #-------------------------------------------------------------------------------
+        def drain(self):
+            # runs everything queued so far; returns the number of events handled
+            with self.lock:
+                self.spill()
+                if not self.entries:
+                    return 0
+                entries = self.entries
+                self.entries = deque()
+                self.latest = dict()
+            perf = self.plugin.perf
+            self.dirty = dict()
+            try:
+                for entry in entries:
+                    if perf:
+                        perf.record('event queue lag', None, time.time() - entry.queued)
+                    if entry.devId is None:
+                        # actions and start/stop see current aggregates
+                        self.flush()
+                    try:
+                        entry.func(*entry.args)
+                    except Exception as e:
+                        self.logger.exception(e)
+                self.flush()
+            finally:
+                self.dirty = None
+            return len(entries)
+
+        #-------------------------------------------------------------------------------
+        def recompute(self, devGroup):
+            # a group's fans changed; while draining, recompute it once at the end of the batch
+            if self.dirty is None:
+                devGroup.updateGroup()
+            elif devGroup.id not in self.dirty:
+                self.dirty[devGroup.id] = devGroup
+            else:
+                perf = self.plugin.perf
+                if perf:
+                    perf.count('group recomputes merged')
+
+        #-------------------------------------------------------------------------------
+        def flush(self):
+            if self.dirty:
+                dirty = self.dirty
+                self.dirty = dict()
+                # nested groups before the groups that contain them
+                for devGroup in sorted(dirty.values(), key=lambda devGroup: len(devGroup.nested)):
+                    # skip groups stopped since they were marked
+                    if self.plugin.deviceDict.get(devGroup.id) is devGroup:
+                        try:
+                            devGroup.updateGroup()
+                        except Exception as e:
+                            self.logger.exception(e)
+
+        ###############################################################################
+        class Entry(object):
+            __slots__ = ('devId', 'func', 'args', 'queued')
+
+            #-------------------------------------------------------------------------------
+            def __init__(self, devId, func, args):
+                self.devId      = devId
+                self.func       = func
+                self.args       = args
+                self.queued     = time.time()
+
+    ###############################################################################
+    class Scheduler(object):
+        # Timer jobs kept in a heap ordered by deadline. runConcurrentThread sleeps
+        # until the earliest deadline and is woken early when a sooner job is added.
+        # Cancelled jobs are dropped lazily when they reach the top of the heap.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin):
+            self.plugin     = plugin
+            self.logger     = plugin.logger
+            self.heap       = list()
+            self.lock       = threading.Lock()
+            self.event      = threading.Event()
+            self.sequence   = itertools.count()
+
+        #-------------------------------------------------------------------------------
+        def schedule(self, when, callback):
+            job = self.Job(when, callback)
+            with self.lock:
+                heapq.heappush(self.heap, (when, next(self.sequence), job))
+                if self.heap[0][2] is job:
+                    self.event.set()
+            return job
+
+        #-------------------------------------------------------------------------------
+        def cancel(self, job):
+            # returns None so callers can clear their handle in one statement
+            if job:
+                job.cancelled = True
+            return None
+
+        #-------------------------------------------------------------------------------
+        def reschedule(self, job, when, callback):
+            self.cancel(job)
+            return self.schedule(when, callback)
+
+        #-------------------------------------------------------------------------------
+        def nextDeadline(self):
+            with self.lock:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                return self.heap[0][0] if self.heap else None
+
+        #-------------------------------------------------------------------------------
+        def runDue(self):
+            while True:
+                with self.lock:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap or self.heap[0][0] > time.time():
+                        return
+                    when, sequence, job = heapq.heappop(self.heap)
+                trace = self.plugin.trace
+                if trace:
+                    trace.record('timer', cb=getattr(job.callback, '__qualname__', ''))
+                try:
+                    job.callback()
+                except Exception as e:
+                    self.logger.exception(e)
+
+        #-------------------------------------------------------------------------------
+        def wait(self, ready=None):
+            # clear first so a job added while computing the timeout still wakes us;
+            # returns at once if ready() says there is other work waiting
+            self.event.clear()
+            if ready and ready():
+                return
+            deadline = self.nextDeadline()
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            self.event.wait(timeout)
+
+        #-------------------------------------------------------------------------------
+        def wake(self):
+            self.event.set()
+
+        ###############################################################################
+        class Job(object):
+            __slots__ = ('when', 'callback', 'cancelled')
+
+            #-------------------------------------------------------------------------------
+            def __init__(self, when, callback):
+                self.when       = when
+                self.callback   = callback
+                self.cancelled  = False
+
+    ###############################################################################
+    class PerfStats(object):
+        # Call counts and fixed-bucket latency histograms per entry point, and per
+        # entry point and group. Memory is bounded by entry points x groups.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self):
+            self.lock       = threading.Lock()
+            self.reset()
+
+        #-------------------------------------------------------------------------------
+        def reset(self):
+            with self.lock:
+                self.started    = time.time()
+                self.entries    = dict()
+                self.groups     = dict()
+                self.counters   = dict()
+
+        #-------------------------------------------------------------------------------
+        def timed(self, name, label, func, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, label, time.perf_counter() - started)
+
+        #-------------------------------------------------------------------------------
+        def record(self, name, label, elapsed):
+            bucket = bisect.bisect_left(kLatencyBuckets, elapsed)
+            with self.lock:
+                self.add(self.entries, name, bucket, elapsed)
+                if label:
+                    self.add(self.groups, (name, label), bucket, elapsed)
+
+        #-------------------------------------------------------------------------------
+        def add(self, table, key, bucket, elapsed):
+            entry = table.get(key)
+            if not entry:
+                # [count, total seconds, max seconds, bucket counts]
+                entry = table[key] = [0, 0.0, 0.0, [0]*(len(kLatencyBuckets)+1)]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3][bucket] += 1
+
+        #-------------------------------------------------------------------------------
+        def count(self, name, value=1):
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+        #-------------------------------------------------------------------------------
+        def peak(self, name, value):
+            with self.lock:
+                self.counters[name] = max(self.counters.get(name, 0), value)
+
+        #-------------------------------------------------------------------------------
+        def percentile(self, entry, pct):
+            # upper bound of the bucket holding the pct-th sample (max for the overflow bucket)
+            target = entry[0] * pct / 100.0
+            seen = 0
+            for bucket, count in enumerate(entry[3]):
+                seen += count
+                if seen >= target and count:
+                    return kLatencyBuckets[bucket] if bucket < len(kLatencyBuckets) else entry[2]
+            return entry[2]
+
+        #-------------------------------------------------------------------------------
+        def describe(self, name, entry):
+            ms = lambda seconds: f'{seconds*1000:.2f}'
+            return (f'{name}: {entry[0]} calls, avg {ms(entry[1]/entry[0])} ms, '
+                    f'p50 <{ms(self.percentile(entry, 50))} ms, p90 <{ms(self.percentile(entry, 90))} ms, '
+                    f'p99 <{ms(self.percentile(entry, 99))} ms, max {ms(entry[2])} ms')
+
+        #-------------------------------------------------------------------------------
+        def summary(self):
+            with self.lock:
+                entries  = dict(self.entries)
+                groups   = dict(self.groups)
+                counters = dict(self.counters)
+            lines = [f'Performance stats for the last {int(time.time()-self.started)} seconds:']
+            for name in sorted(entries):
+                lines.append('    ' + self.describe(name, entries[name]))
+            for name in sorted(counters):
+                lines.append(f'    {name}: {counters[name]}')
+            for name in sorted(entries):
+                slowest = sorted(((entry[1], label, entry) for (entryName, label), entry in groups.items()
+                                  if entryName == name), key=lambda item: item[0], reverse=True)
+                if slowest:
+                    lines.append(f'  {name} by group (top {kPerfTopGroups} by total time):')
+                    for total, label, entry in slowest[:kPerfTopGroups]:
+                        lines.append('        ' + self.describe(f'"{label}"', entry))
+            return lines
+
+    ###############################################################################
+    class DeviceCatalog(object):
+        # Names of the speedcontrol and thermostat devices the config UI offers,
+        # and the members of our own groups that can be nested, kept current from
+        # deviceCreated/deviceDeleted/deviceUpdated so dialogs and validation don't
+        # scan the device database.
+
+        #-------------------------------------------------------------------------------
+        def __init__(self, plugin):
+            self.pluginId       = plugin.pluginId
+            self.fans           = dict()
+            self.thermostats    = dict()
+            self.groups         = dict()
+            self.fanListCache   = None
+
+        #-------------------------------------------------------------------------------
+        def add(self, dev):
+            if dev.pluginId == self.pluginId:
+                if dev.deviceTypeId in kNestableTypes:
+                    self.groups[dev.id] = (dev.name, [int(fanId) for fanId in dev.pluginProps.get('fans',[])])
+            elif isinstance(dev, indigo.SpeedControlDevice):
+                self.fans[dev.id] = dev.name
+                self.fanListCache = None
+            elif isinstance(dev, indigo.ThermostatDevice):
+                self.thermostats[dev.id] = dev.name
+
+        #-------------------------------------------------------------------------------
+        def remove(self, devId):
+            self.groups.pop(devId, None)
+            self.thermostats.pop(devId, None)
+            if self.fans.pop(devId, None) is not None:
+                self.fanListCache = None
+
+        #-------------------------------------------------------------------------------
+        def rename(self, dev):
+            if dev.id in self.fans:
+                self.fans[dev.id] = dev.name
+                self.fanListCache = None
+            elif dev.id in self.thermostats:
+                self.thermostats[dev.id] = dev.name
+            elif dev.id in self.groups:
+                self.groups[dev.id] = (dev.name, self.groups[dev.id][1])
+
+        #-------------------------------------------------------------------------------
+        def fanList(self):
+            if self.fanListCache is None:
+                self.fanListCache = sorted(self.fans.items(), key=lambda item: item[1].lower())
+            return list(self.fanListCache)
+
+        #-------------------------------------------------------------------------------
+        def groupList(self, groupId=0):
+            # groups that groupId may contain: not itself, nor any group that contains it
+            groupList = [(devId, f'{name} (group)') for devId, (name, members) in self.groups.items()
+                         if devId != groupId and groupId not in self.expand(members)[1]]
+            return sorted(groupList, key=lambda item: item[1].lower())
+
+        #-------------------------------------------------------------------------------
+        def expand(self, memberIds):
+            # returns (leaf fan ids, nested group ids) reachable from memberIds; each
+            # group is visited once, so a cycle can't loop forever, and deleted
+            # devices are skipped
+            leafIds = set()
+            nested  = set()
+            stack   = list(memberIds)
+            while stack:
+                memberId = stack.pop()
+                if memberId in self.groups:
+                    if memberId not in nested:
+                        nested.add(memberId)
+                        stack.extend(self.groups[memberId][1])
+                elif memberId in self.fans:
+                    leafIds.add(memberId)
+            return leafIds, frozenset(nested)
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Offline benchmark for the Fan Group plugin.
+#
+# Builds a synthetic topology against the fake indigo module (fakeindigo.py),
+# then drives the plugin's callbacks and reports per-event latency percentiles,
+# server state writes per event and outgoing commands per action.
+#
+#   python tools/benchmark.py --fans 1000 --groups 200 --events 5000
+
+import argparse
+import json
+import logging
+import random
+import time
+
+import fakeindigo as fi
+
+kGroupTypes = ['fanGroupFull', 'fanGroupSimple']
+kLogic      = {'fanGroupFull':['avg','min','max','all'], 'fanGroupSimple':['any','avg','min','max','all']}
+
+###############################################################################
+class Stats(object):
+
+    def __init__(self, name):
+        self.name       = name
+        self.samples    = list()
+        self.writes     = 0
+        self.commands   = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered)*pct/100.0), len(ordered)-1)]
+
+    def report(self):
+        count = len(self.samples)
+        return {
+            'scenario':         self.name,
+            'events':           count,
+            'p50_us':           round(self.percentile(50)*1e6, 1),
+            'p90_us':           round(self.percentile(90)*1e6, 1),
+            'p99_us':           round(self.percentile(99)*1e6, 1),
+            'max_us':           round(max(self.samples or [0])*1e6, 1),
+            'writes_per_event': round(float(self.writes)/count, 3) if count else 0.0,
+            'cmds_per_event':   round(float(self.commands)/count, 3) if count else 0.0,
+            }
+
+###############################################################################
+def buildTopology(args, rng):
+    fi.server.reset()
+    plugin = fi.loadPlugin(prefs=args.prefs)
+    plugin.logger.setLevel(logging.WARNING)
+
+    fans    = [fi.addFan(f'Fan {i:04d}', rng.randrange(4)) for i in range(args.fans)]
+    others  = [fi.addFan(f'Unwatched {i:04d}') for i in range(args.unwatched)]
+    therms  = [fi.addThermostat(f'Thermostat {i:02d}', temp=72.0+rng.random()*6, coolSet=74.0,
+                                coolOn=rng.random() < 0.5) for i in range(args.therms)]
+    groups  = list()
+    for i in range(args.groups):
+        typeId = rng.choice(kGroupTypes)
+        members = rng.sample(fans, rng.randint(args.minSize, args.maxSize))
+        groups.append(fi.addGroup(f'Group {i:03d}', typeId, [fan.id for fan in members],
+                                  statusLogic=rng.choice(kLogic[typeId])))
+    for i in range(args.assists):
+        members = rng.sample(fans, rng.randint(args.minSize, args.maxSize))
+        groups.append(fi.addGroup(f'Assist {i:03d}', 'thermAssist', [fan.id for fan in members],
+                                  thermostat=str(rng.choice(therms).id), tempFreq='60'))
+
+    plugin.startup()
+    started = time.perf_counter()
+    for group in groups:
+        plugin.deviceStartComm(fi.devices[group.id])
+    startSeconds = time.perf_counter() - started
+    # runConcurrentThread would drop the startup fan snapshot at this point
+    plugin.fanSnapshot.clear()
+    fi.server.drain()
+    return plugin, fans, others, therms, groups, startSeconds
+
+###############################################################################
+def measure(stats, func):
+    writes   = len(fi.server.writes)
+    commands = len(fi.server.commands)
+    started  = time.perf_counter()
+    func()
+    stats.add(time.perf_counter() - started)
+    stats.writes   += len(fi.server.writes) - writes
+    stats.commands += len(fi.server.commands) - commands
+
+def deliver(oldDev, newDev, plugin):
+    return lambda: plugin.deviceUpdated(oldDev, newDev)
+
+def fanEvent(dev, rng):
+    raw = fi.devices.raw(dev.id)
+    old = raw._copy()
+    speedIndex = rng.randrange(4)
+    raw.states.update(speedIndex=speedIndex, speedLevel=fi.kIndexLevel[speedIndex])
+    return old, raw._copy()
+
+def scenarioFanUpdates(plugin, fans, args, rng):
+    stats = Stats('deviceUpdated: watched fan')
+    for i in range(args.events):
+        oldDev, newDev = fanEvent(rng.choice(fans), rng)
+        measure(stats, deliver(oldDev, newDev, plugin))
+        fi.server.drain()
+    return stats
+
+def scenarioUnwatched(plugin, others, args, rng):
+    stats = Stats('deviceUpdated: unwatched device')
+    if others:
+        for i in range(args.events):
+            oldDev, newDev = fanEvent(rng.choice(others), rng)
+            measure(stats, deliver(oldDev, newDev, plugin))
+    return stats
+
+def scenarioThermostats(plugin, therms, args, rng):
+    stats = Stats('deviceUpdated: thermostat')
+    if therms:
+        for i in range(args.events):
+            raw = fi.devices.raw(rng.choice(therms).id)
+            old = raw._copy()
+            raw.temperatures[0] = round(raw.temperatures[0] + rng.choice([-0.5, 0.5]), 1)
+            raw.syncStates()
+            measure(stats, deliver(old, raw._copy(), plugin))
+            fi.server.drain()
+    return stats
+
+def scenarioUpdateGroup(plugin, args, rng):
+    stats = Stats('FanGroup.updateGroup')
+    groups = list(plugin.deviceDict.values())
+    for i in range(args.events):
+        measure(stats, rng.choice(groups).updateGroup)
+    fi.server.drain()
+    return stats
+
+def scenarioActions(plugin, groups, args, rng):
+    # callback latency and commands sent by the action itself; the echoes that
+    # follow are measured separately as 'action settle'
+    stats  = Stats('actionControlSpeedControl')
+    settle = Stats('action settle (echo delivery)')
+    speedGroups = [group for group in groups if group.deviceTypeId == 'fanGroupFull']
+    for i in range(args.actions):
+        group  = fi.devices[rng.choice(speedGroups).id]
+        action = fi.Action(speedControlAction=fi.kSpeedControlAction.SetSpeedIndex, actionValue=rng.randrange(4))
+        measure(stats, lambda: plugin.actionControlSpeedControl(action, group))
+        # let any concurrent dispatch finish before counting the echoes
+        time.sleep(args.actionPause)
+        measure(settle, fi.server.drain)
+        plugin.scheduler.runDue()
+    return [stats, settle]
+
+def scenarioSweeps(plugin, fans, args, rng):
+    # every watched fan reports twice, as in a mesh-wide status sweep; run once
+    # inline and once through the event queue (callbacks, then one drain)
+    inline    = Stats('sweep inline (whole sweep)')
+    callbacks = Stats('sweep queued: callbacks')
+    drain     = Stats('sweep queued: drain')
+    def sweep():
+        for i in range(2):
+            for fan in fans:
+                oldDev, newDev = fanEvent(fan, rng)
+                plugin.deviceUpdated(oldDev, newDev)
+    for i in range(args.sweeps):
+        measure(inline, sweep)
+        fi.server.drain()
+    plugin.events.start()
+    for i in range(args.sweeps):
+        measure(callbacks, sweep)
+        measure(drain, plugin.events.drain)
+        # echoes of the state writes queue too
+        fi.server.drain()
+        plugin.events.drain()
+    plugin.events.stop()
+    return [inline, callbacks, drain]
+
+def scenarioTicks(plugin, args, rng):
+    stats = Stats('runConcurrentThread tick')
+    for i in range(args.ticks):
+        for therm in plugin.thermostats.values():
+            therm.pollStart = (therm.pollStart or time.time()) - 3600
+            therm.schedulePoll()
+        measure(stats, plugin.scheduler.runDue)
+        fi.server.drain()
+    return stats
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fans',       type=int,   default=1000)
+    parser.add_argument('--unwatched',  type=int,   default=500)
+    parser.add_argument('--groups',     type=int,   default=200)
+    parser.add_argument('--assists',    type=int,   default=20)
+    parser.add_argument('--therms',     type=int,   default=5)
+    parser.add_argument('--minSize',    type=int,   default=4)
+    parser.add_argument('--maxSize',    type=int,   default=40)
+    parser.add_argument('--events',     type=int,   default=2000)
+    parser.add_argument('--actions',    type=int,   default=200)
+    parser.add_argument('--ticks',      type=int,   default=50)
+    parser.add_argument('--sweeps',     type=int,   default=10)
+    parser.add_argument('--actionPause', type=float, default=0.0)
+    parser.add_argument('--pref',       action='append', default=[], metavar='KEY=VALUE',
+                        help='plugin preference override, may be repeated')
+    parser.add_argument('--seed',       type=int,   default=1)
+    parser.add_argument('--json',       action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    args.prefs = dict(pref.split('=', 1) for pref in args.pref)
+    for key, value in args.prefs.items():
+        if value.lower() in ('true','false'):
+            args.prefs[key] = value.lower() == 'true'
+
+    logging.basicConfig(level=logging.WARNING)
+    rng = random.Random(args.seed)
+    plugin, fans, others, therms, groups, startSeconds = buildTopology(args, rng)
+
+    results = list()
+    results.append(scenarioFanUpdates(plugin, fans, args, rng))
+    results.append(scenarioUnwatched(plugin, others, args, rng))
+    results.append(scenarioThermostats(plugin, therms, args, rng))
+    results.append(scenarioUpdateGroup(plugin, args, rng))
+    results.extend(scenarioActions(plugin, groups, args, rng))
+    results.extend(scenarioSweeps(plugin, fans, args, rng))
+    results.append(scenarioTicks(plugin, args, rng))
+    plugin.shutdown()
+
+    report = {
+        'topology': {'fans':args.fans, 'unwatched':args.unwatched, 'groups':args.groups,
+                     'assists':args.assists, 'thermostats':args.therms, 'prefs':args.prefs},
+        'startup_ms': round(startSeconds*1000, 1),
+        'scenarios': [stats.report() for stats in results],
+        }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"topology: {report['topology']}")
+    print(f"deviceStartComm for all groups: {report['startup_ms']} ms")
+    header = f"{'scenario':34} {'events':>7} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'max us':>9} {'writes/ev':>10} {'cmds/ev':>8}"
+    print(header)
+    print('-'*len(header))
+    for row in report['scenarios']:
+        print(f"{row['scenario']:34} {row['events']:>7} {row['p50_us']:>9} {row['p90_us']:>9} {row['p99_us']:>9} "
+              f"{row['max_us']:>9} {row['writes_per_event']:>10} {row['cmds_per_event']:>8}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# In-process stand-in for the Indigo host's "indigo" module.
+#
+# Only the parts of the API the Fan Group plugin touches are implemented.
+# Outgoing commands mutate the fake device database and queue the matching
+# deviceUpdated callbacks, which are delivered by calling server.pump().
+# Every command and state write is recorded so benchmarks and replays can
+# count them.
+
+import copy
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+kPluginPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                           'Fan Group.indigoPlugin', 'Contents', 'Server Plugin', 'plugin.py')
+kPluginId   = 'com.morris.fan-group'
+
+###############################################################################
+# enums
+
+class _Enum(object):
+    def __init__(self, name, members):
+        self._name = name
+        for member in members:
+            setattr(self, member, f'{name}.{member}')
+
+kSpeedControlAction = _Enum('kSpeedControlAction', ['TurnOn','TurnOff','Toggle','SetSpeedIndex',
+                            'SetSpeedLevel','IncreaseSpeedIndex','DecreaseSpeedIndex'])
+kDeviceAction       = _Enum('kDeviceAction', ['TurnOn','TurnOff','Toggle'])
+kUniversalAction    = _Enum('kUniversalAction', ['RequestStatus','Beep','EnergyUpdate','EnergyReset'])
+
+###############################################################################
+# containers
+
+class Dict(dict):
+    pass
+
+class List(list):
+    pass
+
+###############################################################################
+# devices
+
+class Device(object):
+    _nextId = 100000000
+
+    def __init__(self, name, pluginId='', deviceTypeId='', props=None, states=None, devId=None):
+        if devId is None:
+            Device._nextId += 1
+            devId = Device._nextId
+        self.id             = devId
+        self.name           = name
+        self.pluginId       = pluginId
+        self.deviceTypeId   = deviceTypeId
+        self.pluginProps    = Dict(props or {})
+        self.states         = Dict(states or {})
+        self.configured     = True
+        self.enabled        = True
+
+    @property
+    def version(self):
+        return self.pluginProps.get('version')
+
+    def _copy(self):
+        dup = copy.copy(self)
+        dup.pluginProps = Dict(self.pluginProps)
+        dup.states      = Dict(self.states)
+        return dup
+
+    # state writes from plugins
+    def updateStateOnServer(self, key, value, **kwargs):
+        server.stateWrite(self, [{'key':key, 'value':value}])
+
+    def updateStatesOnServer(self, stateList):
+        server.stateWrite(self, list(stateList))
+
+    def replacePluginPropsOnServer(self, props):
+        devices.raw(self.id).pluginProps = Dict(props)
+        self.pluginProps = Dict(props)
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    def refreshFromServer(self):
+        self.__dict__.update(devices.raw(self.id)._copy().__dict__)
+
+class RelayDevice(Device):
+    @property
+    def onState(self):
+        return bool(self.states.get('onOffState', False))
+
+class DimmerDevice(RelayDevice):
+    pass
+
+class SensorDevice(Device):
+    @property
+    def onState(self):
+        return bool(self.states.get('onOffState', False))
+
+class SpeedControlDevice(Device):
+    def __init__(self, name, speedIndex=0, **kwargs):
+        Device.__init__(self, name, **kwargs)
+        self.states.setdefault('speedIndex', speedIndex)
+        self.states.setdefault('speedLevel', kIndexLevel[speedIndex])
+
+    @property
+    def speedIndex(self):
+        return self.states.get('speedIndex') or 0
+
+    @property
+    def speedLevel(self):
+        return self.states.get('speedLevel') or 0
+
+    @property
+    def onState(self):
+        return self.speedLevel > 0
+
+class ThermostatDevice(Device):
+    def __init__(self, name, temp=72.0, coolSet=74.0, heatSet=68.0, coolOn=False, heatOn=False, **kwargs):
+        Device.__init__(self, name, **kwargs)
+        self.temperatures   = [temp]
+        self.humidities     = [45.0]
+        self.coolSetpoint   = coolSet
+        self.heatSetpoint   = heatSet
+        self.coolIsOn       = coolOn
+        self.heatIsOn       = heatOn
+        self.syncStates()
+
+    def _copy(self):
+        dup = Device._copy(self)
+        dup.temperatures = list(self.temperatures)
+        dup.humidities   = list(self.humidities)
+        return dup
+
+    def syncStates(self):
+        self.states.update({
+            'temperatureInput1':    self.temperatures[0],
+            'humidityInput1':       self.humidities[0],
+            'setpointCool':         self.coolSetpoint,
+            'setpointHeat':         self.heatSetpoint,
+            'hvacCoolerIsOn':       self.coolIsOn,
+            'hvacHeaterIsOn':       self.heatIsOn,
+            })
+
+kIndexLevel = {0:0, 1:33, 2:66, 3:100}
+
+def _levelIndex(level):
+    if level <= 0:
+        return 0
+    elif level <= 33:
+        return 1
+    elif level <= 66:
+        return 2
+    return 3
+
+###############################################################################
+# device database
+
+class _Devices(object):
+    def __init__(self):
+        self._devices = dict()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            for dev in self._devices.values():
+                if dev.name == key:
+                    return dev._copy()
+            raise KeyError(key)
+        return self._devices[key]._copy()
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            return any(dev.name == key for dev in self._devices.values())
+        return key in self._devices
+
+    def __len__(self):
+        return len(self._devices)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iter(self, filter=''):
+        for dev in sorted(self._devices.values(), key=lambda d: d.name.lower()):
+            if _matches(dev, filter):
+                yield dev._copy()
+
+    def subscribeToChanges(self):
+        server.subscribed = True
+
+    # fake-only helpers
+    def add(self, dev):
+        self._devices[dev.id] = dev
+        return dev
+
+    def remove(self, devId):
+        return self._devices.pop(devId)
+
+    def raw(self, devId):
+        return self._devices[devId]
+
+    def values(self):
+        return self._devices.values()
+
+def _matches(dev, filter):
+    if not filter:
+        return True
+    if filter == 'self':
+        return dev.pluginId == kPluginId
+    if filter.startswith('self.'):
+        return dev.pluginId == kPluginId and dev.deviceTypeId == filter[5:]
+    if filter == 'indigo.speedcontrol':
+        return isinstance(dev, SpeedControlDevice)
+    if filter == 'indigo.thermostat':
+        return isinstance(dev, ThermostatDevice)
+    if filter == 'indigo.relay':
+        return isinstance(dev, RelayDevice)
+    if filter == 'indigo.sensor':
+        return isinstance(dev, SensorDevice)
+    return False
+
+###############################################################################
+# command namespaces
+
+class _SpeedControl(object):
+    def setSpeedIndex(self, devId, value):
+        server.command('speedcontrol.setSpeedIndex', devId, value)
+        if server.applyCommands:
+            server.mutate(devId, speedIndex=value, speedLevel=kIndexLevel[value])
+
+    def setSpeedLevel(self, devId, value):
+        server.command('speedcontrol.setSpeedLevel', devId, value)
+        if server.applyCommands:
+            server.mutate(devId, speedIndex=_levelIndex(value), speedLevel=value)
+
+    def turnOn(self, devId):
+        self.setSpeedIndex(devId, 1)
+
+    def turnOff(self, devId):
+        self.setSpeedIndex(devId, 0)
+
+class _Device(object):
+    def statusRequest(self, devId, suppressLogging=False):
+        server.command('device.statusRequest', devId, None)
+
+class _Server(object):
+    def getInstallFolderPath(self):
+        return server.installFolder
+
+    def log(self, message, type=None, isError=False, level=None):
+        logging.getLogger('indigo.server').info(message)
+
+    def getPlugin(self, pluginId):
+        return server.pluginHandle
+
+speedcontrol    = _SpeedControl()
+device          = _Device()
+devices         = _Devices()
+
+class _ServerProxy(object):
+    def __getattr__(self, name):
+        return getattr(_Server(), name)
+
+###############################################################################
+# plugin base
+
+class PluginBase(object):
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId           = pluginId
+        self.pluginDisplayName  = pluginDisplayName
+        self.pluginVersion      = pluginVersion
+        self.pluginPrefs        = pluginPrefs
+        self.logger             = logging.getLogger('Plugin')
+        self.stopThread         = False
+        self.debug              = False
+
+    def __del__(self):
+        pass
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread
+        if seconds > 0:
+            time.sleep(seconds)
+        if self.stopThread:
+            raise self.StopThread
+
+    def stopConcurrentThread(self):
+        self.stopThread = True
+
+    def deviceUpdated(self, oldDev, newDev):
+        pass
+
+    def deviceCreated(self, dev):
+        pass
+
+    def deviceDeleted(self, dev):
+        pass
+
+###############################################################################
+# fake server: records traffic and delivers callbacks
+
+class FakeServer(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.plugin         = None
+        self.pluginHandle   = None
+        self.subscribed     = False
+        self.pending        = list()
+        self.commands       = list()
+        self.writes         = list()
+        self.echo           = True
+        self.applyCommands  = True      # False: commands are only recorded (replays)
+        self.lock           = threading.RLock()
+        self.installFolder  = tempfile.mkdtemp(prefix='fakeindigo-')
+        os.makedirs(os.path.join(self.installFolder, 'Preferences', 'Plugins'), exist_ok=True)
+        devices._devices.clear()
+
+    def command(self, name, devId, value):
+        with self.lock:
+            self.commands.append((name, devId, value))
+
+    def mutate(self, devId, **states):
+        with self.lock:
+            dev = devices.raw(devId)
+            old = dev._copy()
+            dev.states.update(states)
+            if isinstance(dev, ThermostatDevice):
+                dev.syncStates()
+            if self.echo:
+                self.pending.append((old, dev._copy()))
+
+    def setThermostat(self, devId, **attrs):
+        with self.lock:
+            dev = devices.raw(devId)
+            old = dev._copy()
+            for key, value in attrs.items():
+                if key == 'temp':
+                    dev.temperatures[0] = value
+                elif key == 'humidity':
+                    dev.humidities[0] = value
+                else:
+                    setattr(dev, key, value)
+            dev.syncStates()
+            self.pending.append((old, dev._copy()))
+
+    def stateWrite(self, dev, stateList):
+        with self.lock:
+            self.writes.append((dev.id, stateList))
+            raw = devices.raw(dev.id)
+            old = raw._copy()
+            for item in stateList:
+                raw.states[item['key']] = item['value']
+                dev.states[item['key']] = item['value']
+            if self.echo:
+                self.pending.append((old, raw._copy()))
+
+    def pump(self, limit=None):
+        delivered = 0
+        while self.pending and (limit is None or delivered < limit):
+            with self.lock:
+                oldDev, newDev = self.pending.pop(0)
+            if self.plugin:
+                self.plugin.deviceUpdated(oldDev, newDev)
+            delivered += 1
+        return delivered
+
+    def drain(self):
+        # deliver callbacks until no more are generated
+        for _ in range(1000):
+            if not self.pump():
+                break
+
+server = FakeServer()
+
+###############################################################################
+# helpers for harnesses
+
+class Action(object):
+    def __init__(self, speedControlAction=None, deviceAction=None, sensorAction=None, actionValue=None, props=None):
+        self.speedControlAction = speedControlAction
+        self.deviceAction       = deviceAction
+        self.sensorAction       = sensorAction
+        self.actionValue        = actionValue
+        self.props              = Dict(props or {})
+        self.pluginId           = kPluginId
+
+def install():
+    module = sys.modules[__name__]
+    fake = types.ModuleType('indigo')
+    for name in dir(module):
+        if not name.startswith('__'):
+            setattr(fake, name, getattr(module, name))
+    fake.server = _ServerProxy()
+    sys.modules['indigo'] = fake
+    return fake
+
+def loadPlugin(prefs=None, version='0.0.0'):
+    install()
+    spec = importlib.util.spec_from_file_location('fangroup_plugin', kPluginPath)
+    pluginModule = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pluginModule)
+    plugin = pluginModule.Plugin(kPluginId, 'Fan Group', version, Dict(prefs or {}))
+    server.plugin = plugin
+    server.pluginHandle = plugin
+    return plugin
+
+def addFan(name, speedIndex=0):
+    return devices.add(SpeedControlDevice(name, speedIndex=speedIndex))
+
+def addThermostat(name, **kwargs):
+    return devices.add(ThermostatDevice(name, **kwargs))
+
+def addGroup(name, typeId, fans, **props):
+    props['fans'] = List(str(fanId) for fanId in fans)
+    if typeId == 'fanGroupFull':
+        props.setdefault('statusLogic', 'avg')
+        dev = SpeedControlDevice(name, pluginId=kPluginId, deviceTypeId=typeId, props=props)
+    elif typeId == 'fanGroupSimple':
+        props.setdefault('statusLogic', 'any')
+        props.setdefault('onLevel', '1')
+        dev = RelayDevice(name, pluginId=kPluginId, deviceTypeId=typeId, props=props,
+                          states={'onOffState':False})
+    else:
+        props.setdefault('onLevel', '1')
+        props.setdefault('onThreshold', '2.0')
+        props.setdefault('offThreshold', '1.0')
+        props.setdefault('onOverride', True)
+        props.setdefault('offOverride', True)
+        props.setdefault('tempFreq', '300')
+        dev = SensorDevice(name, pluginId=kPluginId, deviceTypeId=typeId, props=props,
+                           states={'onOffState':False})
+    return devices.add(dev)
@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Replays an event trace recorded by the plugin ("Record event trace" in the
+# plugin config) against the fake indigo module (fakeindigo.py).
+#
+# The groups, fans and thermostats named in the trace are recreated, then each
+# recorded fan/thermostat update and action is fed to the plugin in order. By
+# default a virtual clock jumps from event to event (and through any timers due
+# in between), so a day of trace replays in seconds; --realtime waits out the
+# recorded gaps instead. Reports the state writes and fan commands each event
+# caused and per-event processing time.
+#
+#   python tools/replay.py com.morris.fan-group.trace.jsonl.1 com.morris.fan-group.trace.jsonl
+#   python tools/replay.py trace.jsonl --realtime --speed 10
+
+import argparse
+import json
+import logging
+import time
+
+import fakeindigo as fi
+from benchmark import Stats
+
+kGroupDevices = {
+    'fanGroupFull':     fi.SpeedControlDevice,
+    'fanGroupSimple':   fi.RelayDevice,
+    'thermAssist':      fi.SensorDevice,
+    }
+
+###############################################################################
+class VirtualClock(object):
+    # stands in for the time module inside the plugin
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+###############################################################################
+def loadTrace(paths):
+    events = list()
+    for path in paths:
+        with open(path) as traceFile:
+            for line in traceFile:
+                if line.strip():
+                    events.append(json.loads(line))
+    # files may be given in any order; sort is stable for equal timestamps
+    events.sort(key=lambda event: event['t'])
+    return events
+
+def buildDevices(events):
+    # first mention of each device gives its starting state
+    for event in events:
+        if event['e'] != 'start':
+            continue
+        for fanId, (name, speedIndex, speedLevel) in event['fans'].items():
+            if int(fanId) not in fi.devices:
+                fan = fi.devices.add(fi.SpeedControlDevice(name or f'Fan {fanId}', speedIndex=speedIndex, devId=int(fanId)))
+                fan.states['speedLevel'] = speedLevel
+        if event['therm'] and event['therm'][0] not in fi.devices:
+            thermId, name, temp, coolSet, heatSet, coolOn, heatOn = event['therm']
+            fi.devices.add(fi.ThermostatDevice(name, temp=temp, coolSet=coolSet, heatSet=heatSet,
+                                               coolOn=coolOn, heatOn=heatOn, devId=thermId))
+    for event in events:
+        if event['e'] == 'start' and event['id'] not in fi.devices:
+            props = event['props']
+            props['fans'] = fi.List(props.get('fans', []))
+            fi.devices.add(kGroupDevices[event['type']](event['name'], pluginId=fi.kPluginId, deviceTypeId=event['type'],
+                                                      props=props, states=event['states'], devId=event['id']))
+
+def actionFor(event):
+    # recorded as str(enum), e.g. "kSpeedControlAction.TurnOn" from the fake or "TurnOn" from Indigo
+    enumName, dot, member = event['action'].rpartition('.')
+    enums = [enumName] if enumName else {'speedControl':['kSpeedControlAction','kUniversalAction'],
+                                         'dimmerRelay':['kDeviceAction','kUniversalAction'],
+                                         'sensor':['kUniversalAction']}[event['kind']]
+    value = next((getattr(getattr(fi, name), member) for name in enums if hasattr(getattr(fi, name), member)), None)
+    if event['kind'] == 'speedControl':
+        return fi.Action(speedControlAction=value, actionValue=event['value'])
+    elif event['kind'] == 'dimmerRelay':
+        return fi.Action(deviceAction=value, actionValue=event['value'])
+    return fi.Action(sensorAction=value, actionValue=event['value'])
+
+###############################################################################
+class Replay(object):
+
+    def __init__(self, events, args):
+        self.events     = events
+        self.args       = args
+        self.stats      = dict()
+        self.decisions  = list()
+        self.recordedTimers = 0
+        self.first      = events[0]['t']
+
+        header = next((event for event in events if event['e'] == 'trace'), {'prefs':{}})
+        prefs = dict(header['prefs'])
+        # deterministic replay: serial dispatch, and don't record a trace of the replay
+        prefs.update(concurrentDispatch=False, traceEvents=False)
+        prefs.update(args.prefs)
+        fi.server.applyCommands = False     # fan reports come from the trace, not from our own commands
+        buildDevices(events)
+        self.plugin = fi.loadPlugin(prefs=prefs, version=header.get('pluginVersion', '0.0.0'))
+        self.plugin.logger.setLevel(logging.WARNING)
+        self.clock = None
+        if not args.realtime:
+            self.clock = VirtualClock(self.first)
+            self.plugin.startup.__func__.__globals__['time'] = self.clock
+        self.plugin.startup()
+
+    #-------------------------------------------------------------------------------
+    def run(self):
+        started = self.startedAt = time.time()
+        for index, event in enumerate(self.events):
+            self.advance(event['t'])
+            handler = getattr(self, 'on_' + event['e'], None)
+            if handler:
+                self.measure(event['e'], event, lambda: handler(event))
+        self.plugin.shutdown()
+        return time.time() - started
+
+    #-------------------------------------------------------------------------------
+    def advance(self, when):
+        # run the timers due before the next event, on the virtual or the real clock
+        scheduler = self.plugin.scheduler
+        if self.clock:
+            deadline = scheduler.nextDeadline()
+            while deadline is not None and deadline <= when:
+                self.clock.now = max(self.clock.now, deadline)
+                self.measure('timers', None, scheduler.runDue)
+                deadline = scheduler.nextDeadline()
+            self.clock.now = max(self.clock.now, when)
+            return
+        # realtime: sleep until the event is due, running plugin timers as they come due
+        target = self.startedAt + (when - self.first) / self.args.speed
+        while True:
+            self.measure('timers', None, scheduler.runDue)
+            now = time.time()
+            if now >= target:
+                break
+            deadline = scheduler.nextDeadline()
+            time.sleep(max(min(target, deadline if deadline is not None else target) - now, 0))
+
+    #-------------------------------------------------------------------------------
+    def measure(self, kind, event, func):
+        stats = self.stats.get(kind)
+        if not stats:
+            stats = self.stats[kind] = Stats(kind)
+        writes   = len(fi.server.writes)
+        commands = len(fi.server.commands)
+        started  = time.perf_counter()
+        func()
+        # echoes of our own state writes belong to the event that caused them
+        fi.server.drain()
+        elapsed  = time.perf_counter() - started
+        newWrites   = fi.server.writes[writes:]
+        newCommands = fi.server.commands[commands:]
+        # timer passes that did nothing aren't events
+        if kind == 'timers' and not (newWrites or newCommands):
+            return
+        stats.add(elapsed)
+        stats.writes   += len(newWrites)
+        stats.commands += len(newCommands)
+        if newWrites or newCommands:
+            offset = self.clock.now - self.first if self.clock else (time.time() - self.startedAt) * self.args.speed
+            self.decisions.append({
+                'offset':   round(offset, 3),
+                'event':    self.describe(kind, event),
+                'writes':   [(fi.devices.raw(devId).name, dict((item['key'], item['value']) for item in stateList))
+                             for devId, stateList in newWrites],
+                'commands': [(name.rpartition('.')[2], fi.devices.raw(devId).name, value) for name, devId, value in newCommands],
+                })
+
+    #-------------------------------------------------------------------------------
+    def describe(self, kind, event):
+        if not event:
+            return kind
+        name = fi.devices.raw(event['id']).name if event.get('id') in fi.devices else ''
+        if kind in ('fan', 'therm'):
+            return f'{kind} "{name}" {event["p"]}'
+        if kind == 'action':
+            return f'action "{name}" {event["action"]} {event["value"] if event["value"] is not None else ""}'.rstrip()
+        if kind == 'setGroupSpeeds':
+            return f'setGroupSpeeds {event["targets"]}'
+        return f'{kind} "{name}"'
+
+    #-------------------------------------------------------------------------------
+    # event handlers
+    #-------------------------------------------------------------------------------
+    def on_start(self, event):
+        if event['id'] not in self.plugin.deviceDict:
+            self.plugin.deviceStartComm(fi.devices[event['id']])
+
+    def on_stop(self, event):
+        self.plugin.deviceStopComm(fi.devices[event['id']])
+
+    def on_fan(self, event):
+        raw = fi.devices.raw(event['id'])
+        old = raw._copy()
+        raw.states.update(speedIndex=event['p'][0], speedLevel=event['p'][1])
+        self.plugin.deviceUpdated(old, raw._copy())
+
+    def on_therm(self, event):
+        raw = fi.devices.raw(event['id'])
+        old = raw._copy()
+        raw.temperatures[0], raw.coolSetpoint, raw.heatSetpoint, raw.coolIsOn, raw.heatIsOn = event['p']
+        raw.syncStates()
+        self.plugin.deviceUpdated(old, raw._copy())
+
+    def on_action(self, event):
+        device = fi.devices[event['id']]
+        action = actionFor(event)
+        if event['kind'] == 'speedControl':
+            self.plugin.actionControlSpeedControl(action, device)
+        elif event['kind'] == 'dimmerRelay':
+            self.plugin.actionControlDimmerRelay(action, device)
+        else:
+            self.plugin.actionControlSensor(action, device)
+
+    def on_setGroupSpeeds(self, event):
+        self.plugin.setGroupSpeeds(fi.Action(props={'targets':event['targets']}))
+
+    def on_timer(self, event):
+        # the replay fires its own timers; recorded ones are only counted
+        self.recordedTimers += 1
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('trace',        nargs='+', help='trace files, rotated (.N) files included')
+    parser.add_argument('--realtime',   action='store_true', help='wait out the recorded gaps between events')
+    parser.add_argument('--speed',      type=float, default=1.0,
+                        help='with --realtime, shorten the gaps between events N times (plugin timers still run in real time)')
+    parser.add_argument('--pref',       action='append', default=[], metavar='KEY=VALUE',
+                        help='plugin preference override, may be repeated')
+    parser.add_argument('--quiet',      action='store_true', help='summary only')
+    parser.add_argument('--json',       action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    args.prefs = dict(pref.split('=', 1) for pref in args.pref)
+    for key, value in args.prefs.items():
+        if value.lower() in ('true','false'):
+            args.prefs[key] = value.lower() == 'true'
+
+    logging.basicConfig(level=logging.WARNING)
+    events = loadTrace(args.trace)
+    if not events:
+        parser.error('trace is empty')
+    replay = Replay(events, args)
+    seconds = replay.run()
+
+    report = {
+        'events':           len(events),
+        'traceSeconds':     round(events[-1]['t'] - events[0]['t'], 3),
+        'replaySeconds':    round(seconds, 3),
+        'recordedTimers':   replay.recordedTimers,
+        'writes':           len(fi.server.writes),
+        'commands':         len(fi.server.commands),
+        'scenarios':        [stats.report() for stats in replay.stats.values() if stats.samples],
+        'decisions':        replay.decisions,
+        }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    if not args.quiet:
+        for decision in report['decisions']:
+            print(f"[{decision['offset']:>10.3f}] {decision['event']}")
+            for name, states in decision['writes']:
+                print(f"                 write \"{name}\" {states}")
+            for command, name, value in decision['commands']:
+                print(f"                 {command} \"{name}\" {value}")
+    print(f"{report['events']} events over {report['traceSeconds']} s replayed in {report['replaySeconds']} s; "
+          f"{report['writes']} state writes, {report['commands']} commands, {report['recordedTimers']} timers recorded")
+    header = f"{'event':34} {'events':>7} {'p50 us':>9} {'p90 us':>9} {'p99 us':>9} {'max us':>9} {'writes/ev':>10} {'cmds/ev':>8}"
+    print(header)
+    print('-'*len(header))
+    for row in report['scenarios']:
+        print(f"{row['scenario']:34} {row['events']:>7} {row['p50_us']:>9} {row['p90_us']:>9} {row['p99_us']:>9} "
+              f"{row['max_us']:>9} {row['writes_per_event']:>10} {row['cmds_per_event']:>8}")
+
+if __name__ == '__main__':
+    main()